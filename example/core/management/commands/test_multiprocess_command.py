@@ -4,6 +4,7 @@
 
 
 import logging
+import os
 import time
 from django_commands.commands import LargeQuerysetMutiProcessHandlerCommand
 
@@ -16,11 +17,26 @@ LOGGER = logging.getLogger(__name__)
 class Command(LargeQuerysetMutiProcessHandlerCommand):
 
     queryset = CommandLog.objects.all()
+    MAX_TASKS_PER_CHILD = 5
+
+    @classmethod
+    def setup_worker(cls):
+        LOGGER.info("worker %d started", os.getpid())
+
+    @classmethod
+    def teardown_worker(cls):
+        LOGGER.info("worker %d exit", os.getpid())
 
     @classmethod
     def handle_single_task(cls, *args, **kwargs):
         LOGGER.info("update: %s", args[0])
-        CommandLog.objects.filter(
+        return CommandLog.objects.filter(
                 pk__gte=args[0][0],
                 pk__lte=args[0][1],
                 ).update(name=f"updated: {time.time()}")
+
+    def reduce_results(self, accumulator, result):
+        return (accumulator or 0) + result
+
+    def get_row_count(self, result):
+        return result
@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class DjangoCommandsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'django_commands'
+
+    def ready(self):
+        # pylint: disable=import-outside-toplevel
+        from .registry import registry
+        registry.build(getattr(settings, "DJANGO_COMMANDS_ALLOW_REMOTE_CALL", []))
@@ -8,17 +8,25 @@ Usefule Command Class
 """
 
 
+import asyncio
 import datetime
 import logging
+import math
+import os
+import threading
 import time
 
-from contextvars import ContextVar
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from decimal import Decimal
 from multiprocessing import Pool
-from typing import Tuple, Union, Iterable, Optional
+from multiprocessing.util import Finalize
+from queue import Empty, Queue
+from typing import Dict, Tuple, Union, Iterable, Iterator, List, Literal, Optional, Set, Sized
 
-from django.core.management.base import BaseCommand, CommandParser
-from django.db import connections
+from asgiref.sync import sync_to_async
+from django.core.management.base import ALL_CHECKS, BaseCommand, CommandError, CommandParser, OutputWrapper
+from django.core.management.color import color_style, no_style
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
 from django.db.models import QuerySet
 from django.utils import timezone
 
@@ -26,18 +34,27 @@ from django_redis import get_redis_connection
 
 import django_commands
 
-from .mixins import AutoLogMixin, WarmShutdownMixin
+from .locks import AdvisoryLock, RedisLock
+from .mixins import AutoLogMixin, RunStatsMixin, WarmShutdownMixin
+from .queues import ListQueue, ReliableListQueue, StreamQueue, Task, get_async_redis_connection
 from django_commands.types import RedisClient
-from .utils import iter_large_queryset
+from .utils import (
+        TaskStatistics,
+        iter_balanced_ranges,
+        iter_batches,
+        iter_histogram_ranges,
+        iter_keyset_boundaries,
+        iter_pk_ranges,
+        )
 
 
-PROCESS_INITED = ContextVar("inited", default=False)
 LOGGER = logging.getLogger(__name__)
 
 
-class AutoLogCommand(BaseCommand):
+class AutoLogCommand(RunStatsMixin, BaseCommand):
     """
     AutoLogCommand will add log to every exception and then raise it
+    if RECORD_STATS, the stats of the run are saved into CommandLog, see RunStatsMixin
     """
 
     def execute(self, *args, **kwargs):
@@ -61,12 +78,33 @@ class UniqueCommand(AutoLogCommand):
         1. it will create a django_commands.models.CommandLog instance
         2. it will check if there is another Command Instance pending with the same UNIQUE_NAME
 
+    if LOCK_BACKEND = "redis", no CommandLog is created, the command acquires a RedisLock
+    (SET NX PX with a heartbeat) of the UNIQUE_NAME instead. if the process crashes,
+    the lock expires after LOCK_TIMEOUT seconds. use self.lock.fencing_token to fence the writes
+    and self.lock.lost to know if the lock is lost during handle.
+    see django_commands.locks.RedisLock
+
+    if LOCK_BACKEND = "advisory", the command takes a postgresql advisory lock of the UNIQUE_NAME
+    on a dedicated connection of LOCK_DATABASE, it's released as soon as the session dies.
+    see django_commands.locks.AdvisoryLock
+
+    if AUDIT_LOG, the "redis" and "advisory" backends write a finished/failed/skipped CommandLog
+    in a background thread after the command exits.
+    if RECORD_STATS, the stats are saved into the CommandLog of the run (the "db" backend)
+    or a new CommandLog (the lock backends), which is also the audit log written in the background if AUDIT_LOG
     """
     UNIQUE_NAME = ""
     TIMEOUT = datetime.timedelta(days=1)
+    LOCK_BACKEND: Literal["db", "redis", "advisory"] = "db"
+    LOCK_TIMEOUT = 10
+    LOCK_DATABASE = DEFAULT_DB_ALIAS
+    AUDIT_LOG = False
+    _audit_thread: Optional[threading.Thread] = None
 
     def execute(self, *args, **kwargs):
         unique_name = self.get_unique_name()
+        if self.LOCK_BACKEND != "db":
+            return self._execute_with_lock(unique_name)
         new_instance = django_commands.models.CommandLog.objects.create(name=unique_name)
         wait_after = timezone.now() - self.TIMEOUT
         exist_commands = django_commands.models.CommandLog.objects.filter(
@@ -78,12 +116,75 @@ class UniqueCommand(AutoLogCommand):
             new_instance.status = "skipped"
             new_instance.save()
             return
+        status = "failed"
         try:
-            self.handle()
+            with self.recording_stats(log=new_instance):
+                self.handle()
+            status = "finished"
         finally:
-            new_instance.status = "finished"
+            new_instance.status = status
             new_instance.save()
 
+    def _execute_with_lock(self, unique_name: str):
+        self.lock = self.get_lock(unique_name)
+        if not self.lock.acquire():
+            LOGGER.info("%s is running, skip", unique_name)
+            self._write_audit_log(unique_name, "skipped")
+            return
+        log = None
+        if self.AUDIT_LOG and self.should_record_stats():
+            # the stats are saved into the audit log instead of a second CommandLog
+            log = django_commands.models.CommandLog(name=unique_name)
+        status = "failed"
+        try:
+            with self.recording_stats(log=log):
+                self.handle()
+            status = "finished"
+        finally:
+            self.lock.release()
+            if log is None:
+                self._write_audit_log(unique_name, status)
+
+    def get_lock(self, unique_name: str) -> Union[RedisLock, AdvisoryLock]:
+        """
+        the lock of LOCK_BACKEND
+        """
+        if self.LOCK_BACKEND == "redis":
+            return RedisLock(get_redis_connection("default"), f"{unique_name}:lock", timeout=self.LOCK_TIMEOUT)
+        if self.LOCK_BACKEND == "advisory":
+            return AdvisoryLock(unique_name, using=self.LOCK_DATABASE)
+        raise ValueError(f"unknown LOCK_BACKEND: {self.LOCK_BACKEND}")
+
+    def _write_audit_log(self, unique_name: str, status: str) -> Optional[threading.Thread]:
+        if not self.AUDIT_LOG:
+            return None
+        return self._save_in_background([django_commands.models.CommandLog(name=unique_name, status=status)])
+
+    def _save_stats_logs(self) -> None:
+        if self.LOCK_BACKEND == "db" or not self.AUDIT_LOG or not self._stats_logs:
+            super()._save_stats_logs()
+            return
+        # the audit log with the stats is written in the background like the one without stats
+        self._save_in_background(self._stats_logs)
+        self._stats_logs = []
+
+    def _save_in_background(self, logs: List) -> threading.Thread:
+
+        def create():
+            try:
+                django_commands.models.CommandLog.objects.bulk_create(logs)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                LOGGER.exception(error)
+            finally:
+                connections.close_all()
+
+        self._audit_thread = threading.Thread(target=create, name=f"{logs[0].name}:audit")
+        self._audit_thread.start()
+        return self._audit_thread
+
+    def get_log_name(self) -> str:
+        return self.get_unique_name()
+
     def get_unique_name(self) -> str:
         """
         get a unique name for this command
@@ -96,7 +197,7 @@ class UniqueCommand(AutoLogCommand):
         raise NotImplementedError
 
 
-class WaitCommand(AutoLogMixin, WarmShutdownMixin, BaseCommand):
+class WaitCommand(AutoLogMixin, WarmShutdownMixin, RunStatsMixin, BaseCommand):
     """
     A WaitCommand will use the redis blopop
     to run a command as soon as possible
@@ -106,11 +207,62 @@ class WaitCommand(AutoLogMixin, WarmShutdownMixin, BaseCommand):
 
     class variable:
         SQUASH_TASK = True  # wheter squash multi tasks into one
+        BATCH_SIZE = 1  # how many tasks are popped and passed to handle_tasks at once
+        BLOCK_TIMEOUT = 5  # how many seconds to block waiting for a task
+        RELIABLE = False  # whether keep the tasks in a processing list until they are handled
+        CONSUMER_TIMEOUT = 60  # seconds without heartbeat before the tasks of a consumer are recovered
+        PROCESSING_TIMEOUT = None  # seconds before an unacknowledged stream entry is claimed, default CONSUMER_TIMEOUT
+        BACKEND = "list"  # "list" or "stream"
+        STREAM_GROUP = "default"  # the consumer group of the stream backend
+        STREAM_MAXLEN = 100000  # trim the stream to about so many entries
+        DEDUPLICATE = False  # whether skip the task id which is already waiting in the queue
+        DELAYED_TASK = False  # whether support create_task(run_at=..., delay=...)
+        CONCURRENCY = 1  # how many threads handle the tasks
+        PREFETCH = None  # at most so many tasks are popped but not finished, default CONCURRENCY * BATCH_SIZE * 2
+
+    when the queue is empty, it blocks with blpop, and then pops the rest of the batch
+    (and deletes the key if SQUASH_TASK) in one MULTI/EXEC pipeline.
+
+    if RELIABLE, the tasks are moved into a processing list of the consumer (BLMOVE and a lua script)
+    and removed after handle_tasks succeeds. If a consumer crashes, its tasks are moved back to
+    the queue by other consumers after CONSUMER_TIMEOUT. see django_commands.queues.ReliableListQueue
+
+    if BACKEND = "stream", the tasks are added to a redis stream and consumed by the consumer group
+    STREAM_GROUP, so the command can run on many nodes, every entry is acknowledged after it's handled
+    and an entry not acknowledged after PROCESSING_TIMEOUT seconds is claimed by another consumer,
+    so PROCESSING_TIMEOUT must be longer than a task can wait in the PREFETCH window and be handled.
+    with SQUASH_TASK, the entries not delivered yet are acknowledged by the consumer which pops a batch.
+    The stream can carry a payload: `create_task(task_id, payload={...})` and the payload
+    is passed to `handle_task(task_id, payload=...)`. Use `get_backlog()` to get the length/pending/lag.
+    see django_commands.queues.StreamQueue
+
+    if DEDUPLICATE, the same task id created many times before it's popped will run only once.
+    if DELAYED_TASK, `create_task(task_id, delay=60)` or `create_task(task_id, run_at=datetime)`
+    puts the task into a sorted set, the due tasks are moved into the queue atomically and
+    the consumer blocks exactly until the next due task instead of BLOCK_TIMEOUT.
+    DEDUPLICATE and DELAYED_TASK are only supported by the list backend.
+    DELAYED_TASK (ZADD LT) and RELIABLE (BLMOVE) need redis >= 6.2, the stream backend needs redis >= 6.2 (XAUTOCLAIM).
+
+    if CONCURRENCY > 1, the popped batches are handled by CONCURRENCY threads while the loop keeps popping,
+    at most PREFETCH tasks are in flight. every batch is acknowledged after it's handled.
+    when need_stop, the command stops popping and waits for the tasks in flight.
+    if a task raises, the command stops popping, waits for the tasks in flight and raises it.
     """
     NAME = ""
     IMMEDIATELY = False
     SQUASH_TASK = True
     BATCH_SIZE = 1  # how many tasks do you want to pop once
+    BLOCK_TIMEOUT = 5
+    RELIABLE = False
+    CONSUMER_TIMEOUT = 60
+    PROCESSING_TIMEOUT: Optional[float] = None
+    BACKEND: Literal["list", "stream"] = "list"
+    STREAM_GROUP = "default"
+    STREAM_MAXLEN: Optional[int] = 100000
+    DEDUPLICATE = False
+    DELAYED_TASK = False
+    CONCURRENCY = 1
+    PREFETCH: Optional[int] = None
 
     def add_arguments(self, parser: CommandParser):
         parser.add_argument(
@@ -125,9 +277,19 @@ class WaitCommand(AutoLogMixin, WarmShutdownMixin, BaseCommand):
         self.before_handle()
         if self.IMMEDIATELY:
             self.create_task()
-        redis, redis_key = self.get_redis_info()
-        LOGGER.info("rpush %s to trigger task", redis_key)
+        queue = self.get_queue()
+        LOGGER.info("rpush %s to trigger task", queue.key)
         max_run_time = kwargs.get("times", 0)
+        queue.start()
+        try:
+            if self.CONCURRENCY > 1:
+                self._consume_concurrently(queue, max_run_time, *args, **kwargs)
+            else:
+                self._consume(queue, max_run_time, *args, **kwargs)
+        finally:
+            queue.close()
+
+    def _consume(self, queue: ListQueue, max_run_time: int, *args, **kwargs) -> None:
         run_time = 0
         while True:
             if self.need_stop:
@@ -136,22 +298,139 @@ class WaitCommand(AutoLogMixin, WarmShutdownMixin, BaseCommand):
             if max_run_time and run_time >= max_run_time:
                 LOGGER.info("%s has executed as least %d times, bye bye", self, run_time)
                 return
-            key_taskids = redis.lpop(redis_key, self.BATCH_SIZE)
-            if key_taskids is None:
-                key_taskid = redis.blpop(redis_key, timeout=5)
-                if key_taskid is None:
+            queue.maintain()
+            count = self.BATCH_SIZE
+            if max_run_time:
+                count = min(count, max_run_time - run_time)
+            tasks = queue.pop(count, self.BLOCK_TIMEOUT)
+            if not tasks:
+                LOGGER.debug("no task")
+                continue
+            LOGGER.debug("handle task: %s", tasks)
+            self._handle_tasks(tasks, *args, **kwargs)
+            queue.ack(tasks)
+            run_time += len(tasks)
+            self.add_rows(len(tasks))
+
+    def _consume_concurrently(self, queue: ListQueue, max_run_time: int, *args, **kwargs) -> None:
+        window = self.PREFETCH or self.CONCURRENCY * self.BATCH_SIZE * 2
+        pending: Dict[Future, int] = {}
+        run_time = 0
+        todo: Queue = Queue()
+        workers = [
+            threading.Thread(target=self._run_task_worker, args=(queue, todo), name=f"{queue.key}-{i}")
+            for i in range(self.CONCURRENCY)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            while True:
+                for future in [future for future in pending if future.done()]:
+                    handled = pending.pop(future)
+                    run_time += handled
+                    future.result()
+                    self.add_rows(handled)
+                if self.need_stop:
+                    LOGGER.info("stop wait command: %s, wait for %d tasks", self, sum(pending.values()))
+                    break
+                in_flight = sum(pending.values())
+                if max_run_time and run_time + in_flight >= max_run_time:
+                    if not pending:
+                        LOGGER.info("%s has executed as least %d times, bye bye", self, run_time)
+                        return
+                    wait(pending, return_when=FIRST_COMPLETED)
+                    continue
+                if in_flight >= window:
+                    wait(pending, return_when=FIRST_COMPLETED)
+                    continue
+                queue.maintain()
+                count = min(self.BATCH_SIZE, window - in_flight)
+                if max_run_time:
+                    count = min(count, max_run_time - run_time - in_flight)
+                tasks = queue.pop(count, self.BLOCK_TIMEOUT)
+                if not tasks:
                     LOGGER.debug("no task")
                     continue
-                LOGGER.debug("get one task: %s", key_taskid)
-                key_taskids = [key_taskid[1]]
-            else:
-                LOGGER.debug("get multi task one time: %s", key_taskids)
-            if self.SQUASH_TASK:
-                redis.delete(redis_key)
-            LOGGER.debug("handle task: %s", key_taskids)
-            for key_taskid in key_taskids:
-                self.handle_task(key_taskid, *args, **kwargs)
-                run_time += 1
+                LOGGER.debug("handle task: %s", tasks)
+                future: Future = Future()
+                todo.put((future, tasks, args, kwargs))
+                pending[future] = len(tasks)
+        finally:
+            # the workers finish the tasks in flight and exit
+            for _ in workers:
+                todo.put(None)
+            for worker in workers:
+                worker.join()
+
+    def _run_task_worker(self, queue: ListQueue, todo: Queue) -> None:
+        """
+        run in every thread of CONCURRENCY until it gets None, the connections of the thread are closed at exit
+        """
+        try:
+            item = todo.get()
+            while item is not None:
+                future, tasks, args, kwargs = item
+                if future.set_running_or_notify_cancel():
+                    try:
+                        self._handle_tasks_in_thread(queue, tasks, *args, **kwargs)
+                    except BaseException as error:  # pylint: disable=broad-exception-caught
+                        future.set_exception(error)
+                    else:
+                        future.set_result(None)
+                item = todo.get()
+        finally:
+            connections.close_all()
+
+    def _handle_tasks_in_thread(self, queue: ListQueue, tasks: List[Task], *args, **kwargs) -> None:
+        close_old_connections()
+        try:
+            self._handle_tasks(tasks, *args, **kwargs)
+            queue.ack(tasks)
+        finally:
+            close_old_connections()
+
+    def _handle_tasks(self, tasks: List[Task], *args, **kwargs) -> None:
+        task_ids = [task.task_id for task in tasks]
+        if any(task.payload is not None for task in tasks):
+            kwargs["payloads"] = [task.payload for task in tasks]
+        self.handle_tasks(task_ids, *args, **kwargs)
+
+    @classmethod
+    def get_queue(cls) -> ListQueue:
+        """
+        the queue to consume
+        """
+        redis, redis_key = cls.get_redis_info()
+        if cls.BACKEND == "stream":
+            if cls.DEDUPLICATE or cls.DELAYED_TASK:
+                raise ValueError("DEDUPLICATE and DELAYED_TASK are only supported by the list backend")
+            return StreamQueue(
+                    redis, redis_key,
+                    squash=cls.SQUASH_TASK, processing_timeout=cls.PROCESSING_TIMEOUT or cls.CONSUMER_TIMEOUT,
+                    group=cls.STREAM_GROUP, maxlen=cls.STREAM_MAXLEN)
+        if cls.BACKEND != "list":
+            raise ValueError(f"unknown BACKEND: {cls.BACKEND}")
+        if cls.RELIABLE:
+            return ReliableListQueue(
+                    redis, redis_key,
+                    squash=cls.SQUASH_TASK, deduplicate=cls.DEDUPLICATE, delayed=cls.DELAYED_TASK,
+                    consumer_timeout=cls.CONSUMER_TIMEOUT)
+        return ListQueue(
+                redis, redis_key,
+                squash=cls.SQUASH_TASK, deduplicate=cls.DEDUPLICATE, delayed=cls.DELAYED_TASK)
+
+    @classmethod
+    def _get_shared_queue(cls) -> ListQueue:
+        """
+        the queue of create_task, clear_task and get_backlog, built again only if the redis client changes.
+        handle consumes a queue of its own
+        """
+        redis, _ = cls.get_redis_info()
+        queue = cls.__dict__.get("_shared_queue")
+        if queue is None or queue.redis is not redis:
+            queue = cls.get_queue()
+            cls._shared_queue = queue
+        return queue
 
     def before_handle(self) -> None:
         """
@@ -160,6 +439,19 @@ class WaitCommand(AutoLogMixin, WarmShutdownMixin, BaseCommand):
         """
         return
 
+    def handle_tasks(
+            self, task_ids: List[bytes], *args,
+            payloads: Optional[List[Optional[dict]]] = None, **kwargs) -> None:
+        """
+        handle the tasks popped at once, override it if you want to handle them in bulk.
+        payloads is only passed when some of the tasks carry a payload (stream backend)
+        """
+        for index, task_id in enumerate(task_ids):
+            if payloads and payloads[index] is not None:
+                self.handle_task(task_id, *args, payload=payloads[index], **kwargs)
+            else:
+                self.handle_task(task_id, *args, **kwargs)
+
     def handle_task(self, task_id, *args, **kwargs) -> None:
         """
         override the handle_task function to do the real task
@@ -173,36 +465,251 @@ class WaitCommand(AutoLogMixin, WarmShutdownMixin, BaseCommand):
         return redis, redis_key
 
     @classmethod
-    def create_task(cls, task_id: Optional[str] = None) -> None:
-        redis, key = cls.get_redis_info()
+    def create_task(
+            cls, task_id: Optional[str] = None, payload: Optional[dict] = None,
+            run_at: Union[datetime.datetime, float, None] = None,
+            delay: Union[datetime.timedelta, float, None] = None) -> None:
+        """
+        run_at (datetime or timestamp) or delay (seconds or timedelta) needs DELAYED_TASK = True
+        """
+        task_id = task_id or str(time.time())
+        cls._get_shared_queue().push([task_id], [payload], run_at=cls._get_run_at(run_at, delay))
+
+    @classmethod
+    def create_tasks(
+            cls, task_ids: Iterable[str], chunk_size: int = 1000,
+            run_at: Union[datetime.datetime, float, None] = None,
+            delay: Union[datetime.timedelta, float, None] = None) -> int:
+        """
+        push many tasks in one pipeline, chunk_size tasks per RPUSH.
+        the duplicated task ids are dropped if SQUASH_TASK.
+        return how many tasks are pushed
+        """
+        task_ids = cls._unique_task_ids(task_ids)
+        if task_ids:
+            cls._get_shared_queue().push(task_ids, chunk_size=chunk_size, run_at=cls._get_run_at(run_at, delay))
+        return len(task_ids)
+
+    @classmethod
+    async def acreate_task(
+            cls, task_id: Optional[str] = None, payload: Optional[dict] = None,
+            run_at: Union[datetime.datetime, float, None] = None,
+            delay: Union[datetime.timedelta, float, None] = None) -> None:
+        """
+        same as create_task, but use the redis.asyncio client, so it can be used in the async views
+        """
         task_id = task_id or str(time.time())
-        redis.rpush(key, task_id)
+        await cls._get_shared_queue().apush(
+                get_async_redis_connection(), [task_id], [payload],
+                run_at=cls._get_run_at(run_at, delay))
+
+    @classmethod
+    async def acreate_tasks(
+            cls, task_ids: Iterable[str], chunk_size: int = 1000,
+            run_at: Union[datetime.datetime, float, None] = None,
+            delay: Union[datetime.timedelta, float, None] = None) -> int:
+        """
+        same as create_tasks, but use the redis.asyncio client
+        """
+        task_ids = cls._unique_task_ids(task_ids)
+        if task_ids:
+            await cls._get_shared_queue().apush(
+                    get_async_redis_connection(), task_ids, chunk_size=chunk_size,
+                    run_at=cls._get_run_at(run_at, delay))
+        return len(task_ids)
+
+    @staticmethod
+    def _get_run_at(
+            run_at: Union[datetime.datetime, float, None],
+            delay: Union[datetime.timedelta, float, None]) -> Optional[float]:
+        if run_at is not None and delay is not None:
+            raise ValueError("run_at and delay can not be used together")
+        if isinstance(run_at, datetime.datetime):
+            return run_at.timestamp()
+        if isinstance(delay, datetime.timedelta):
+            delay = delay.total_seconds()
+        if delay is not None:
+            return time.time() + delay
+        return run_at
+
+    @classmethod
+    def _unique_task_ids(cls, task_ids: Iterable[str]) -> List[str]:
+        if cls.SQUASH_TASK:
+            return list(dict.fromkeys(task_ids))
+        return list(task_ids)
 
     @classmethod
     def clear_task(cls) -> None:
-        redis, key = cls.get_redis_info()
-        redis.delete(key)
+        cls._get_shared_queue().clear()
+
+    @classmethod
+    def get_backlog(cls) -> Dict[str, Optional[int]]:
+        """
+        the length (and pending, lag for the stream backend) of the queue
+        """
+        return cls._get_shared_queue().info()
+
+
+class _HandleLoopCommand(BaseCommand):
+    """
+    set up the command (arguments, checks, output) once like BaseCommand.execute
+    and call _run_loop(handle) instead of handle.
+    it must be the last base before BaseCommand, so the execute of the mixins wraps the whole loop
+
+    every handle is recorded as a run by RunStatsMixin.
+    only a bool or a non-negative int returned by handle is counted as the items, other values are ignored.
+    if ADAPTIVE_INTERVAL, the return value adapts the interval:
+        anything else: wait INTERVAL
+        True or n > 0 items: did work, wait MIN_INTERVAL (run again at once by default)
+        False or 0: idle, wait INTERVAL, then INTERVAL * BACKOFF_FACTOR ... at most MAX_INTERVAL
+    """
+    INTERVAL: float = 1.0
+    ADAPTIVE_INTERVAL = False
+    MIN_INTERVAL: float = 0
+    MAX_INTERVAL: Optional[float] = None  # default INTERVAL
+    BACKOFF_FACTOR: float = 2.0
+
+    def execute(self, *args, **options):
+        if options.get("force_color") and options.get("no_color"):
+            raise CommandError("The --no-color and --force-color options can't be used together.")
+        if options.get("force_color"):
+            self.style = color_style(force_color=True)
+        elif options.get("no_color"):
+            self.style = no_style()
+            self.stderr.style_func = None
+        if options.get("stdout"):
+            self.stdout = OutputWrapper(options["stdout"])
+        if options.get("stderr"):
+            self.stderr = OutputWrapper(options["stderr"])
+        if self.requires_system_checks and not options.get("skip_checks"):
+            if self.requires_system_checks == ALL_CHECKS:
+                self.check()
+            else:
+                self.check(tags=self.requires_system_checks)
+        if self.requires_migrations_checks:
+            self.check_migrations()
+        self.current_interval = self.INTERVAL
+        self._loop_metrics = {"runs": 0, "idle_runs": 0, "items": 0, "start": time.monotonic()}
+        self._run_loop(self.handle, *args, **options)
+
+    def _run_loop(self, handle, *args, **options) -> None:
+        raise NotImplementedError
+
+    def _run_once(self, handle, *args, **options) -> Tuple[bool, Optional[bool]]:
+        """
+        run handle once and adapt current_interval,
+        return whether the loop should stop and whether handle did work (None if unknown)
+        """
+        try:
+            output = handle(*args, **options)
+        except StopIteration:
+            LOGGER.debug("StopIteration occured, %s will exit", self)
+            return True, None
+        if output and isinstance(output, str):
+            self.stdout.write(output)
+        items = self._get_items(output)
+        if items is not None and not isinstance(output, bool):
+            self.add_rows(items)
+        self.record_run("finished")
+        return False, self._adapt_interval(output, items)
+
+    @staticmethod
+    def _get_items(output) -> Optional[int]:
+        """
+        how many items are handled if handle returns a bool or a non-negative int, otherwise None
+        """
+        if isinstance(output, bool):
+            return int(output)
+        if isinstance(output, int) and output >= 0:
+            return output
+        return None
+
+    def _adapt_interval(self, output, items: Optional[int]) -> Optional[bool]:
+        self._loop_metrics["runs"] += 1
+        if items is not None and not isinstance(output, bool):
+            self._loop_metrics["items"] += items
+        if items is None or not self.ADAPTIVE_INTERVAL:
+            self.current_interval = self.INTERVAL
+            return None
+        if items:
+            self.current_interval = self.MIN_INTERVAL
+            return True
+        self._loop_metrics["idle_runs"] += 1
+        max_interval = self.INTERVAL if self.MAX_INTERVAL is None else self.MAX_INTERVAL
+        self.current_interval = min(max(self.current_interval * self.BACKOFF_FACTOR, self.INTERVAL), max_interval)
+        LOGGER.debug("%s is idle, current_interval: %s", self, self.current_interval)
+        return False
+
+    def get_metrics(self) -> Dict[str, float]:
+        """
+        runs, idle_runs, items, current_interval and items_per_second of the loop
+        """
+        elapsed = time.monotonic() - self._loop_metrics["start"]
+        return {
+            "runs": self._loop_metrics["runs"],
+            "idle_runs": self._loop_metrics["idle_runs"],
+            "items": self._loop_metrics["items"],
+            "current_interval": self.current_interval,
+            "items_per_second": self._loop_metrics["items"] / elapsed if elapsed > 0 else 0,
+        }
 
 
-class MultiTimesCommand(AutoLogMixin, WarmShutdownMixin, BaseCommand):
+class MultiTimesCommand(AutoLogMixin, WarmShutdownMixin, RunStatsMixin, _HandleLoopCommand):
     """
     MultiTimesCommand will run multi times according to INTERVAL AND MAX_TIMES
 
     you can use `kill -TERM <processid>` to kill the command
     you can set MAX_TIMES to decimal.Decimal("inf") to run forever
+
+    the command is set up (arguments, checks) only once, then handle runs at the fixed ticks
+    start + n * INTERVAL of the monotonic clock, so the period does not drift with the running time.
+    if handle runs longer than INTERVAL, OVERRUN decides what to do:
+        "skip": skip the missed ticks and wait for the next one (default)
+        "catch_up": run the missed ticks one by one without waiting
+        "immediate": run again at once and count the following ticks from now
+    raise StopIteration in handle to stop the loop.
+    if ADAPTIVE_INTERVAL and handle returns True/False or the number of handled items, the interval adapts
+    between MIN_INTERVAL and MAX_INTERVAL instead of the fixed ticks, see _HandleLoopCommand.
+    the command stops at once when it's waiting for the next tick and receives the TERM signal,
+    or after the current handle finished.
     """
     INTERVAL = 1.0
     MAX_TIMES: Union[Decimal, int] = 60
+    OVERRUN: Literal["skip", "catch_up", "immediate"] = "skip"
     run_cnt = 0
 
-    def execute(self, *args, **kwargs):
-        while self.run_cnt < self.MAX_TIMES:
+    def _run_loop(self, handle, *args, **options) -> None:
+        start = time.monotonic()
+        tick = 0
+        while self.run_cnt < self.MAX_TIMES and not self.need_stop:
             self.run_cnt += 1
-            try:
-                super().execute(*args, **kwargs)
-            except StopIteration:
+            stop, busy = self._run_once(handle, *args, **options)
+            if stop or self.run_cnt >= self.MAX_TIMES:
+                break
+            if busy is None:
+                start, tick = self._get_next_tick(start, tick + 1)
+            else:
+                start, tick = time.monotonic() + self.current_interval, 0
+            if self.wait(start + tick * self.INTERVAL - time.monotonic()):
+                LOGGER.info("stop %s", self)
                 break
-            time.sleep(self.INTERVAL)
+
+    def _get_next_tick(self, start: float, tick: int) -> Tuple[float, int]:
+        """
+        return the (start, tick) of the next run according to OVERRUN
+        """
+        now = time.monotonic()
+        if now <= start + tick * self.INTERVAL or self.OVERRUN == "catch_up":
+            return start, tick
+        if self.INTERVAL <= 0:
+            return now, 0
+        if self.OVERRUN == "immediate":
+            return now, 0
+        if self.OVERRUN != "skip":
+            raise ValueError(f"unknown OVERRUN: {self.OVERRUN}")
+        next_tick = math.floor((now - start) / self.INTERVAL) + 1
+        LOGGER.warning("%s overran, skip %d ticks", self, next_tick - tick)
+        return start, next_tick
 
 
 class RunForeverCommand(MultiTimesCommand):
@@ -215,56 +722,402 @@ class RunForeverCommand(MultiTimesCommand):
     MAX_TIMES = Decimal("inf")
 
 
-class DurationCommand(AutoLogCommand):
+class DurationCommand(WarmShutdownMixin, AutoLogCommand, _HandleLoopCommand):
     """
     DurationCommand will run the command multi times until the running time exceed the MAX_DURATION(default 1 minute)
+    the command is set up only once and stops at once when it's waiting and receives the TERM signal
+    if ADAPTIVE_INTERVAL, handle can return True/False or the number of handled items to adapt the interval,
+    see _HandleLoopCommand
     """
     INTERVAL = 1
     DURATION = datetime.timedelta(minutes=1)
 
-    def execute(self, *args, **kwargs):
-        duration = self.DURATION
-        end_time = datetime.datetime.now() + duration
-        LOGGER.info("end_time: %s", end_time)
-        while datetime.datetime.now() < end_time:
-            try:
-                self.handle(*args, **kwargs)
-            except StopIteration:
-                LOGGER.debug("StopIteration occured, DurationCommand will exit")
+    def _run_loop(self, handle, *args, **options) -> None:
+        end_time = time.monotonic() + self.DURATION.total_seconds()
+        LOGGER.info("end_time: %s", datetime.datetime.now() + self.DURATION)
+        while time.monotonic() < end_time and not self.need_stop:
+            stop, _ = self._run_once(handle, *args, **options)
+            if stop:
+                break
+            if self.wait(min(self.current_interval, end_time - time.monotonic())):
+                LOGGER.info("stop %s", self)
                 break
-            time.sleep(self.INTERVAL)
 
     def handle(self, *args, **kwargs):
         raise NotImplementedError
 
 
+class _Throttle:
+    """
+    limit how many items of an iterable are consumed before they are released.
+    the iterable is consumed by the task handler thread of the Pool
+    """
+
+    def __init__(self, limit: Optional[int]):
+        self.limit = limit
+        self.closed = False
+        self.semaphore = threading.Semaphore(limit or 0)
+
+    def iter(self, iterable: Iterable) -> Iterator:
+        iterator = iter(iterable)
+        while True:
+            if self.limit:
+                self.semaphore.acquire()
+            if self.closed:
+                return
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+
+    def release(self, count: int = 1) -> None:
+        if self.limit:
+            self.semaphore.release(count)
+
+    def close(self) -> None:
+        """wake up the consumer so the Pool can exit"""
+        self.closed = True
+        self.release(self.limit or 0)
+
+
 class MultiProcessCommand(AutoLogCommand):
     """
     A multiprocess command will use the multiprocessing.Pool to handler task.  
     You need to inherit it and custom the `get_tasks` and `handle_single_task`.  
+    Set EXECUTOR = "thread" to use a thread pool for I/O bound tasks, or EXECUTOR = "async"
+    to run the tasks in an event loop, handle_single_task can be a coroutine then.
+    `--jobs` means the concurrency (processes, threads or coroutines) of every EXECUTOR.  
+    setup_worker and teardown_worker are called in every thread for "thread", and once for "async".
+    every thread closes its database connections when it exits.
+    `get_tasks` can be a generator, the tasks will be dispatched as soon as they are yielded.  
+    Set PREFETCH_PER_JOB to limit how many tasks are read ahead of the workers.  
+
+    Every worker process drops the database connections inherited from the parent,
+    opens its own connections to WORKER_DATABASES and keeps them for all its tasks.
+    Override `setup_worker` to warm up the worker (load caches, compile regexes)
+    and `teardown_worker` to clean it up.
+    Set MAX_TASKS_PER_CHILD to replace the worker after so many batches, in case of memory leak.
+
+    The tasks are sent to the workers in batches of CHUNK_SIZE (or `--chunk-size`) to save the IPC cost.
+    If neither is set, the chunk size is computed from the number of tasks and jobs when `get_tasks`
+    returns a list, otherwise 1.
+    Override `handle_batch` if you want to handle a batch of tasks together,
+    like in one transaction or one bulk_update.
+
+    Every result is passed to `reduce_results` in the parent process, the final value is
+    kept in `self.accumulator`. `self.statistics` reports the throughput every PROGRESS_INTERVAL seconds
+    and the latency percentiles of every worker at last, override `get_row_count` to report rows/s.
     """
+    EXECUTOR: Literal["process", "thread", "async"] = "process"
+    PREFETCH_PER_JOB: Optional[int] = None
+    CHUNK_SIZE: Optional[int] = None
+    PROGRESS_INTERVAL = 10
+    MAX_TASKS_PER_CHILD: Optional[int] = None
+    WORKER_DATABASES: List[str] = [DEFAULT_DB_ALIAS]
 
     def add_arguments(self, parser: CommandParser):
         parser.add_argument(
                 "-j", "--jobs", type=int,
-                help="how many process")
+                help="how many processes/threads/coroutines run the tasks concurrently")
+        parser.add_argument(
+                "--chunk-size", type=int,
+                help="how many tasks are sent to a worker at once")
         super().add_arguments(parser)
 
-    def handle(self, *args, jobs=None, **kwargs):
-        start = timezone.now()
+    def handle(self, *args, jobs=None, chunk_size=None, **kwargs):
         tasks = self.get_tasks()
         LOGGER.debug("handle task: %s", tasks)
-        with Pool(jobs) as p:
-            for result in p.imap_unordered(
-                self.handle_single_task, tasks):
-                LOGGER.debug("handle single task done: %s", result)
+        jobs = jobs or self.get_default_jobs()
+        chunk_size = self.get_chunk_size(tasks, jobs, chunk_size)
+        self.accumulator = self.get_initial_accumulator()
+        self.statistics = TaskStatistics(
+                total=len(tasks) if isinstance(tasks, Sized) else None,
+                interval=self.PROGRESS_INTERVAL)
+        batches = iter_batches(tasks, chunk_size)
+        if self.EXECUTOR == "process":
+            self._run_in_processes(batches, jobs)
+        elif self.EXECUTOR == "thread":
+            self._run_in_threads(batches, jobs)
+        elif self.EXECUTOR == "async":
+            asyncio.run(self._run_in_coroutines(batches, jobs))
+        else:
+            raise ValueError(f"unknown EXECUTOR: {self.EXECUTOR}")
+        self.statistics.finish()
+        self.statistics.report_summary()
+
+    def _run_in_processes(self, batches: Iterator[List], jobs: int) -> None:
+        throttle = _Throttle(self.get_prefetch(jobs))
+        # the forked workers must not share the connections of the parent
+        connections.close_all()
+        try:
+            with Pool(
+                    jobs,
+                    initializer=self._init_worker,
+                    maxtasksperchild=self.MAX_TASKS_PER_CHILD) as p:
+                for batch_result in p.imap_unordered(self._handle_batch, throttle.iter(batches)):
+                    throttle.release()
+                    self._collect(*batch_result)
+                # let the workers exit normally so teardown_worker is called
+                p.close()
+                p.join()
+        finally:
+            throttle.close()
+
+    def _run_in_threads(self, batches: Iterator[List], jobs: int) -> None:
+        limit = self.get_prefetch(jobs) or jobs * 2
+        todo: Queue = Queue()
+        done: Queue = Queue()
+        workers = [
+            threading.Thread(
+                target=self._run_thread_worker, args=(todo, done), name=f"{self.__class__.__name__}-{i}")
+            for i in range(jobs)
+        ]
+        for worker in workers:
+            worker.start()
+        pending = 0
+        try:
+            for batch in batches:
+                if pending >= limit:
+                    self._collect_thread_result(*done.get())
+                    pending -= 1
+                todo.put(batch)
+                pending += 1
+            for _ in range(pending):
+                self._collect_thread_result(*done.get())
+        finally:
+            # drop the batches not started if a worker failed
+            while True:
+                try:
+                    todo.get_nowait()
+                except Empty:
+                    break
+            for _ in workers:
+                todo.put(None)
+            for worker in workers:
+                worker.join()
+        while not done.empty():
+            self._collect_thread_result(*done.get())
+
+    def _collect_thread_result(self, error: Optional[Exception], batch_result: Optional[Tuple]) -> None:
+        if error is not None:
+            raise error
+        self._collect(*batch_result)
+
+    async def _run_in_coroutines(self, batches: Iterator[List], jobs: int) -> None:
+        semaphore = asyncio.Semaphore(jobs)
+        pending: Set[asyncio.Task] = set()
+        errors: List[Exception] = []
+
+        async def run(batch):
+            try:
+                self._collect(*await self._handle_batch_async(batch))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                semaphore.release()
+
+        # get_tasks may query the database, so it can not run in the event loop
+        next_batch = self._sync_to_async(next)
+        await self._sync_to_async(self.setup_worker)()
+        try:
+            while not errors:
+                await semaphore.acquire()
+                batch = await next_batch(batches, None)
+                if batch is None:
+                    break
+                task = asyncio.create_task(run(batch))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            await asyncio.gather(*pending)
+        finally:
+            await self._sync_to_async(self.teardown_worker, close_all=True)()
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _sync_to_async(func, thread_sensitive: bool = True, close_all: bool = False):
+        """
+        sync_to_async, but close the connections func leaves in the thread of asgiref
+        """
+        def call(*args, **kwargs):
+            close_old_connections()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if close_all:
+                    connections.close_all()
+                else:
+                    close_old_connections()
+
+        return sync_to_async(call, thread_sensitive=thread_sensitive)
+
+    def _collect(self, worker, results: List, latencies: List[float]) -> None:
+        """
+        handle the results returned by a worker, in the parent process
+        """
+        for result, latency in zip(results, latencies):
+            LOGGER.debug("handle single task done: %s", result)
+            self.accumulator = self.reduce_results(self.accumulator, result)
+            rows = self.get_row_count(result)
+            self.statistics.add(worker, latency, rows)
+            self.add_rows(rows)
+        self.statistics.report()
+
+    def get_initial_accumulator(self):
+        """
+        the initial value passed to reduce_results
+        """
+        return None
+
+    def reduce_results(self, accumulator, result):
+        """
+        called in the parent process for the result of every task, return the new accumulator
+        """
+        return accumulator
+
+    def get_row_count(self, result) -> int:
+        """
+        how many rows are handled by the task, used to report rows/s
+        """
+        return 0
+
+    def get_chunk_size(self, tasks: Iterable, jobs: int, chunk_size: Optional[int] = None) -> int:
+        """
+        how many tasks are sent to a worker at once
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        if chunk_size:
+            return chunk_size
+        if not isinstance(tasks, Sized):
+            return 1
+        # same as multiprocessing.Pool.map: about 4 chunks for every worker
+        chunk_size, extra = divmod(len(tasks), jobs * 4)
+        return max(chunk_size + bool(extra), 1)
+
+    def get_prefetch(self, jobs: int) -> Optional[int]:
+        """
+        how many batches can be dispatched before finished, None means no limit
+        """
+        if not self.PREFETCH_PER_JOB:
+            return None
+        return self.PREFETCH_PER_JOB * jobs
+
+    def get_default_jobs(self) -> int:
+        if self.EXECUTOR == "process":
+            return os.cpu_count() or 1
+        # same as concurrent.futures.ThreadPoolExecutor
+        return min(32, (os.cpu_count() or 1) + 4)
+
+    @classmethod
+    def _run_thread_worker(cls, todo: Queue, done: Queue) -> None:
+        """
+        run in every thread of the "thread" EXECUTOR until it gets None,
+        put (error, batch result) of every batch into done. the thread exits after an error
+        """
+        try:
+            for alias in cls.WORKER_DATABASES:
+                connections[alias].ensure_connection()
+            cls.setup_worker()
+            try:
+                batch = todo.get()
+                while batch is not None:
+                    done.put((None, cls._handle_batch(batch)))
+                    batch = todo.get()
+            finally:
+                cls.teardown_worker()
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            done.put((error, None))
+        finally:
+            connections.close_all()
+
+    @classmethod
+    def _init_worker(cls) -> None:
+        connections.close_all()
+        for alias in cls.WORKER_DATABASES:
+            connections[alias].ensure_connection()
+        cls.setup_worker()
+        Finalize(None, cls._teardown_worker, exitpriority=10)
+
+    @classmethod
+    def _teardown_worker(cls) -> None:
+        try:
+            cls.teardown_worker()
+        finally:
+            connections.close_all()
+
+    @classmethod
+    def setup_worker(cls) -> None:
+        """
+        called only once in every worker before it handles any task
+        """
+        return
+
+    @classmethod
+    def teardown_worker(cls) -> None:
+        """
+        called only once in every worker when it exits
+        """
+        return
+
+    @classmethod
+    def _handle_batch(cls, tasks: List) -> Tuple[int, List, List[float]]:
+        """
+        run in the worker, return (pid, results, latency of every task)
+        """
+        worker = cls._get_worker_name()
+        if cls.handle_batch.__func__ is MultiProcessCommand.handle_batch.__func__:
+            results, latencies = [], []
+            for task in tasks:
+                start = time.monotonic()
+                results.append(cls.handle_single_task(task))
+                latencies.append(time.monotonic() - start)
+            return worker, results, latencies
+        start = time.monotonic()
+        results = cls.handle_batch(tasks)
+        latency = (time.monotonic() - start) / max(len(tasks), 1)
+        return worker, results, [latency] * len(results)
+
+    @classmethod
+    async def _handle_batch_async(cls, tasks: List) -> Tuple[int, List, List[float]]:
+        """
+        run in the event loop, the sync handle_single_task/handle_batch will run in a thread
+        """
+        worker = cls._get_worker_name()
+        if cls.handle_batch.__func__ is MultiProcessCommand.handle_batch.__func__:
+            handle_single_task = cls.handle_single_task
+            if not asyncio.iscoroutinefunction(handle_single_task):
+                handle_single_task = cls._sync_to_async(handle_single_task, thread_sensitive=False)
+            results, latencies = [], []
+            for task in tasks:
+                start = time.monotonic()
+                results.append(await handle_single_task(task))
+                latencies.append(time.monotonic() - start)
+            return worker, results, latencies
+        handle_batch = cls.handle_batch
+        if not asyncio.iscoroutinefunction(handle_batch):
+            handle_batch = cls._sync_to_async(handle_batch, thread_sensitive=False)
+        start = time.monotonic()
+        results = await handle_batch(tasks)
+        latency = (time.monotonic() - start) / max(len(tasks), 1)
+        return worker, results, [latency] * len(results)
+
+    @classmethod
+    def _get_worker_name(cls):
+        if cls.EXECUTOR == "thread":
+            return threading.current_thread().name
+        return os.getpid()
+
+    @classmethod
+    def handle_batch(cls, tasks: List) -> List:
+        """
+        handle a batch of tasks in the worker and return the result of every task
+        """
+        return [cls.handle_single_task(task) for task in tasks]
 
     @classmethod
     def handle_single_task(cls, *args, **kwargs):
         """handle single task"""
-        if PROCESS_INITED.get() is False:
-            PROCESS_INITED.set(True)
-            # connections.close_all()
         raise NotImplementedError
 
     def get_tasks(self):
@@ -273,32 +1126,63 @@ class MultiProcessCommand(AutoLogCommand):
 
 
 class LargeQuerysetMutiProcessHandlerCommand(MultiProcessCommand):
+    """
+    split the queryset into (first pk, last pk) ranges and handle them with multiprocess
+
+    class variable:
+        PARTITION = "keyset"  # how to split the queryset
+            "keyset": walk the queryset, every range has exactly BATCH_SIZE rows
+            "range": split [min(pk), max(pk)] into ranges with the width of BATCH_SIZE (integer pk only)
+            "histogram": split by the histogram of postgresql statistics, fall back to "range"
+        MAX_RANGE_COUNT = None  # if set, bisect the "range"/"histogram" ranges having more rows and skip empty ones
+    """
     queryset: QuerySet = None
     DURATION = datetime.timedelta(minutes=1)
     BATCH_SIZE = 256
     MAX_TASK: Union[Decimal, int] = Decimal("inf")
+    PREFETCH_PER_JOB = 2
+    PARTITION: Literal["keyset", "range", "histogram"] = "keyset"
+    MAX_RANGE_COUNT: Optional[int] = None
 
     def get_queryset(self):
         if self.queryset is None:
             raise ValueError("Please set queryset on the commands")
         return self.queryset
 
-    def get_tasks(self) -> Iterable[Tuple[int, int]]:
-        """use iter_large_queryset util to iterate a large queryset"""
+    def get_ranges(self) -> Iterator[Tuple[int, int]]:
+        """
+        return the (first pk, last pk) ranges according to PARTITION
+        """
+        queryset = self.get_queryset()
+        if self.PARTITION == "keyset":
+            return (
+                (first[0], last[0])
+                for first, last in iter_keyset_boundaries(queryset, self.BATCH_SIZE)
+            )
+        if self.PARTITION == "range":
+            ranges = iter_pk_ranges(queryset, self.BATCH_SIZE)
+        elif self.PARTITION == "histogram":
+            ranges = iter_histogram_ranges(queryset, self.BATCH_SIZE)
+        else:
+            raise ValueError(f"unknown PARTITION: {self.PARTITION}")
+        if self.MAX_RANGE_COUNT:
+            ranges = iter_balanced_ranges(queryset, ranges, self.MAX_RANGE_COUNT)
+        return ranges
+
+    def get_tasks(self) -> Iterator[Tuple[int, int]]:
+        """
+        yield (first pk, last pk) as soon as the boundary of a batch is known
+        """
         end_datetime = timezone.now() + self.DURATION
-        results = []
-        for queryset in iter_large_queryset(self.get_queryset(), self.BATCH_SIZE):
-            if timezone.now() > end_datetime:
-                break
-            if not queryset:
-                break
-            assert queryset.first()
-            assert queryset.last()
-            results.append((queryset.first().pk, queryset.last().pk))
-            if len(results) >= self.MAX_TASK:
-                break
-        connections.close_all()
-        return results
+        try:
+            for cnt, task in enumerate(self.get_ranges(), 1):
+                if timezone.now() > end_datetime:
+                    break
+                yield task
+                if cnt >= self.MAX_TASK:
+                    break
+        finally:
+            connections.close_all()
 
     @classmethod
     def handle_single_task(cls, *args, **kwargs):
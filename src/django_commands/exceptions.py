@@ -5,3 +5,15 @@
 
 class NoErrorException(Exception):
     pass
+
+
+class JobQueueFull(Exception):
+    """
+    too many command jobs are waiting or running
+    """
+
+
+class IdempotencyKeyConflict(Exception):
+    """
+    the idempotency key is used by a job of another command, args or kwargs
+    """
@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+run the commands called remotely as CommandJob.
+the thread jobs run in a bounded thread pool of the web process.
+the limits of the pool are counted in memory, so they are per process: with 4 gunicorn workers,
+DJANGO_COMMANDS_COMMAND_CONCURRENCY = {"slow_command": 1} still allows 4 slow_command at the same time.
+use the celery calls and the queue of a single worker if a command must not run concurrently
+
+settings:
+    DJANGO_COMMANDS_MAX_WORKERS = 4  # how many commands run at the same time in a process
+    DJANGO_COMMANDS_MAX_JOBS = 100  # how many commands are waiting or running at most in a process
+    DJANGO_COMMANDS_COMMAND_CONCURRENCY = {"slow_command": 1}  # how many jobs of a command at most in a process
+    DJANGO_COMMANDS_JOB_STALE_TIMEOUT = datetime.timedelta(minutes=10)  # a job without heartbeat is stale
+    DJANGO_COMMANDS_JOB_WAIT_TIMEOUT = 30  # how many seconds a local call waits for the job it's coalesced into
+"""
+
+
+import datetime
+import hashlib
+import io
+import json
+import logging
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Literal, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Concat
+from django.utils import timezone
+
+from .exceptions import IdempotencyKeyConflict, JobQueueFull
+from .models import CommandJob
+from .registry import call_command
+
+
+LOGGER = logging.getLogger(__name__)
+_EXECUTOR_LOCK = threading.Lock()
+_EXECUTOR: Optional["CommandExecutor"] = None
+
+
+class CommandExecutor:
+    """
+    run the commands in a ThreadPoolExecutor,
+    raise JobQueueFull instead of queueing more than max_jobs jobs (or command_concurrency jobs of a command).
+    the jobs are counted in this process only, the jobs of other processes and celery are not limited
+    """
+
+    def __init__(
+            self, max_workers: int = 4, max_jobs: int = 100,
+            command_concurrency: Optional[Dict[str, int]] = None):
+        self.max_jobs = max_jobs
+        self.command_concurrency = command_concurrency or {}
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="django_commands")
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.command_jobs: Dict[str, int] = defaultdict(int)
+
+    def submit(
+            self, command: str, args: Optional[List] = None, kwargs: Optional[Dict] = None,
+            **job_fields) -> str:
+        """
+        create the CommandJob (with job_fields), queue the command and return the job id
+        """
+        self.reserve(command)
+        try:
+            with transaction.atomic():
+                job = CommandJob.objects.create(
+                        command=command, using="thread", args=args or [], kwargs=kwargs or {}, **job_fields)
+        except Exception:
+            self._release(command)
+            raise
+        self.submit_job(job)
+        return job.job_id
+
+    def reserve(self, command: str) -> None:
+        """
+        take a place of the queue for the command, raise JobQueueFull if it's full
+        """
+        with self.lock:
+            if self.jobs >= self.max_jobs:
+                raise JobQueueFull(f"{self.jobs} jobs are waiting or running")
+            limit = self.command_concurrency.get(command)
+            if limit is not None and self.command_jobs[command] >= limit:
+                raise JobQueueFull(f"{self.command_jobs[command]} jobs of `{command}` are waiting or running")
+            self.jobs += 1
+            self.command_jobs[command] += 1
+
+    def release_jobs(self, jobs: List[CommandJob]) -> None:
+        """
+        give back the places reserved for the jobs which are not submitted
+        """
+        for job in jobs:
+            self._release(job.command)
+
+    def submit_job(self, job: CommandJob) -> None:
+        """
+        queue a created job, the place must be reserved
+        """
+        try:
+            self.executor.submit(self._run, job.job_id, job.command, job.args, job.kwargs)
+        except Exception:
+            self._release(job.command)
+            raise
+
+    def _run(self, job_id: str, command: str, args: List, kwargs: Dict) -> None:
+        try:
+            run_job(job_id, command, args, kwargs)
+        finally:
+            connections.close_all()
+            self._release(command)
+
+    def _release(self, command: str) -> None:
+        with self.lock:
+            self.jobs -= 1
+            self.command_jobs[command] -= 1
+
+
+def get_executor() -> CommandExecutor:
+    """
+    the CommandExecutor of the process, created with the settings at the first call
+    """
+    global _EXECUTOR  # pylint: disable=global-statement
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = CommandExecutor(
+                    max_workers=getattr(settings, "DJANGO_COMMANDS_MAX_WORKERS", 4),
+                    max_jobs=getattr(settings, "DJANGO_COMMANDS_MAX_JOBS", 100),
+                    command_concurrency=getattr(settings, "DJANGO_COMMANDS_COMMAND_CONCURRENCY", {}),
+            )
+        return _EXECUTOR
+
+
+class JobOutput(io.TextIOBase):
+    """
+    buffer the text written and append it to CommandJob.output when flushed.
+    the heartbeat thread of the job flushes it every FLUSH_INTERVAL seconds
+    """
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self, job_id: str):
+        super().__init__()
+        self.job_id = job_id
+        self.buffer: List[str] = []
+        self.lock = threading.Lock()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        with self.lock:
+            self.buffer.append(text)
+        return len(text)
+
+    def flush(self) -> None:
+        with self.lock:
+            chunk = "".join(self.buffer)
+            self.buffer = []
+        if not chunk:
+            return
+        updated = 0
+        try:
+            updated = CommandJob.objects.filter(job_id=self.job_id).update(
+                    output=Concat(F("output"), Value(chunk)))
+        finally:
+            # the job may not be visible to this connection yet (created in the transaction of a request),
+            # keep the chunk for the next flush
+            if not updated:
+                with self.lock:
+                    self.buffer.insert(0, chunk)
+
+
+class JobLogHandler(logging.Handler):
+    """
+    write the log records of a thread into the JobOutput
+    """
+
+    def __init__(self, output: JobOutput, thread_id: int, level=logging.INFO):
+        super().__init__(level)
+        self.output = output
+        self.thread_id = thread_id
+        self.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s %(name)s %(message)s"))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.thread != self.thread_id:
+            return
+        try:
+            self.output.write(self.format(record) + "\n")
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.handleError(record)
+
+
+def run_job(job_id: str, command: str, args: List, kwargs: Dict) -> None:
+    """
+    call the command in this thread, save its status, stdout, stderr and log records into the CommandJob.
+    the output is flushed and the heartbeat of the job is refreshed in another thread while the command runs
+    """
+    if not CommandJob.objects.filter(job_id=job_id, status="queued").update(
+            status="running", start_datetime=timezone.now(), heartbeat_datetime=timezone.now()):
+        # the job is failed as stale before it runs
+        LOGGER.warning("job %s is not queued, skip", job_id)
+        return
+    LOGGER.info("job %s started: %s", job_id, command)
+    output = JobOutput(job_id)
+    handler = JobLogHandler(output, threading.get_ident())
+    logging.getLogger().addHandler(handler)
+    stopped = threading.Event()
+    heartbeat = threading.Thread(
+            target=_keep_heartbeat, args=(job_id, output, stopped), name=f"{job_id}:heartbeat", daemon=True)
+    heartbeat.start()
+    status, error = "failed", ""
+    try:
+        call_command(command, *args, stdout=output, stderr=output, **kwargs)
+        status = "finished"
+    except Exception as exception:  # pylint: disable=broad-exception-caught
+        LOGGER.exception(exception)
+        error = traceback.format_exc()
+    finally:
+        stopped.set()
+        heartbeat.join()
+        logging.getLogger().removeHandler(handler)
+        output.flush()
+        CommandJob.objects.filter(job_id=job_id).update(
+                status=status, error=error, finish_datetime=timezone.now())
+        LOGGER.info("job %s %s", job_id, status)
+
+
+def _keep_heartbeat(job_id: str, output: JobOutput, stopped: threading.Event) -> None:
+    interval = get_stale_timeout().total_seconds() / 3
+    beaten_at = time.monotonic()
+    try:
+        while not stopped.wait(output.FLUSH_INTERVAL):
+            try:
+                output.flush()
+                if time.monotonic() - beaten_at >= interval:
+                    CommandJob.objects.filter(job_id=job_id).update(heartbeat_datetime=timezone.now())
+                    beaten_at = time.monotonic()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                # e.g. the row of a local job is locked by the transaction of the request
+                LOGGER.warning("can not refresh job %s: %s", job_id, error)
+    finally:
+        connections.close_all()
+
+
+def get_stale_timeout() -> datetime.timedelta:
+    return getattr(settings, "DJANGO_COMMANDS_JOB_STALE_TIMEOUT", datetime.timedelta(minutes=10))
+
+
+def expire_stale_jobs(jobs: Iterable[CommandJob]) -> int:
+    """
+    fail the queued/running jobs of the found jobs without heartbeat for DJANGO_COMMANDS_JOB_STALE_TIMEOUT,
+    e.g. the web process crashed, so they don't absorb the new calls forever.
+    only the jobs conflicting with a call are checked, no query is sent unless one of them is stale
+    """
+    now = timezone.now()
+    stale_before = now - get_stale_timeout()
+    stale_jobs = [
+        job for job in jobs
+        if job.status in ("queued", "running") and job.heartbeat_datetime < stale_before
+    ]
+    if not stale_jobs:
+        return 0
+    count = CommandJob.objects.filter(
+        pk__in=[job.pk for job in stale_jobs],
+        status__in=["queued", "running"],
+        heartbeat_datetime__lt=stale_before,
+    ).update(status="failed", error="the job is stale", finish_datetime=now)
+    if count:
+        LOGGER.warning("%d stale jobs are failed", count)
+    for job in stale_jobs:
+        job.refresh_from_db()
+    return count
+
+
+def get_coalesce_key(command: str, args: List, kwargs: Dict) -> str:
+    """
+    the sha256 of the command, args and kwargs
+    """
+    content = json.dumps([command, args, kwargs], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def find_job(
+        idempotency_key: Optional[str] = None, coalesce_key: Optional[str] = None,
+        request_key: Optional[str] = None) -> Optional[CommandJob]:
+    """
+    the job of the idempotency_key, or the queued/running job of the coalesce_key.
+    raise IdempotencyKeyConflict if the job of the idempotency_key is not of the request_key
+    (get_coalesce_key of the command, args and kwargs)
+    """
+    if idempotency_key:
+        job = CommandJob.objects.filter(idempotency_key=idempotency_key).first()
+        if job is not None:
+            _check_idempotency_key(job, request_key)
+            expire_stale_jobs([job])
+            return job
+    if coalesce_key:
+        job = CommandJob.objects.filter(coalesce_key=coalesce_key, status__in=["queued", "running"]).first()
+        if job is not None:
+            expire_stale_jobs([job])
+            if not job.done:
+                return job
+    return None
+
+
+def _check_idempotency_key(job: CommandJob, request_key: Optional[str]) -> None:
+    if request_key is not None and get_coalesce_key(job.command, job.args, job.kwargs) != request_key:
+        raise IdempotencyKeyConflict(
+                f"idempotency key `{job.idempotency_key}` is used by job {job.job_id} of other arguments")
+
+
+def get_wait_timeout() -> float:
+    return getattr(settings, "DJANGO_COMMANDS_JOB_WAIT_TIMEOUT", 30)
+
+
+def wait_job(job: CommandJob, timeout: Optional[float] = None, interval: float = 0.5) -> CommandJob:
+    """
+    reload the job every interval seconds until it's done or timeout
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not job.done:
+        if deadline is None:
+            time.sleep(interval)
+        elif time.monotonic() < deadline:
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+        else:
+            break
+        job.refresh_from_db()
+    return job
+
+
+def start_job(
+        command: str, using: Literal["celery", "thread", "local"] = "local",
+        args: Optional[List] = None, kwargs: Optional[Dict] = None,
+        idempotency_key: Optional[str] = None, coalesce: bool = True) -> Tuple[str, bool]:
+    """
+    create a CommandJob and run it in the request (local), the thread pool or celery,
+    return the job id and whether the job is created.
+
+    if there is a job of the idempotency_key, or the same command, args and kwargs are queued or running
+    (coalesce), the job is returned instead (a local call waits at most DJANGO_COMMANDS_JOB_WAIT_TIMEOUT
+    seconds until it's done). raise IdempotencyKeyConflict if the idempotency_key is used by another call.
+    """
+    args = args or []
+    kwargs = kwargs or {}
+    request_key = get_coalesce_key(command, args, kwargs)
+    coalesce_key = request_key if coalesce else None
+    # retry if the job of the coalesce_key is done between the IntegrityError and find_job
+    for _ in range(3):
+        job = find_job(idempotency_key, coalesce_key, request_key)
+        if job is not None:
+            LOGGER.info("attach to job %s: %s", job.job_id, command)
+            if using == "local":
+                wait_job(job, get_wait_timeout())
+            return job.job_id, False
+        try:
+            return _create_job(command, using, args, kwargs, idempotency_key, coalesce_key), True
+        except IntegrityError:
+            continue
+    raise JobQueueFull(f"can not attach to the job of `{command}`")
+
+
+def _create_job(
+        command: str, using: str, args: List, kwargs: Dict,
+        idempotency_key: Optional[str], coalesce_key: Optional[str]) -> str:
+    # pylint: disable=import-outside-toplevel
+    from .tasks import async_call_command
+    job_fields = {"idempotency_key": idempotency_key, "coalesce_key": coalesce_key}
+    if using == "thread":
+        return get_executor().submit(command, args, kwargs, **job_fields)
+    if using not in ("celery", "local"):
+        raise NotImplementedError(using)
+    with transaction.atomic():
+        job = CommandJob.objects.create(command=command, using=using, args=args, kwargs=kwargs, **job_fields)
+    if using == "celery":
+        async_call_command.delay(command, using, args, kwargs, job_id=job.job_id)
+    else:
+        run_job(job.job_id, command, args, kwargs)
+    return job.job_id
+
+
+def start_jobs(calls: List[Dict]) -> List[Dict]:
+    """
+    start many jobs, every call is a dict of command, using, args, kwargs, idempotency_key and coalesce.
+    the existing jobs are found in two queries, the new jobs are created in one bulk insert
+    and the celery jobs are sent in one group.
+    return {"job_id": ..., "coalesced": ...} or {"job_id": None, "error": ...} of every call.
+    using is "thread" or "celery", call start_job for the local calls.
+    """
+    local_calls = [call["command"] for call in calls if call["using"] == "local"]
+    if local_calls:
+        raise ValueError(f"the local calls can not be started in a batch: {', '.join(local_calls)}")
+    request_keys = [get_coalesce_key(call["command"], call["args"], call["kwargs"]) for call in calls]
+    coalesce_keys = [
+        request_key if call["coalesce"] else None
+        for call, request_key in zip(calls, request_keys)
+    ]
+    idempotency_keys = [call["idempotency_key"] for call in calls]
+    jobs_by_idempotency_key: Dict[str, CommandJob] = {
+        job.idempotency_key: job
+        for job in CommandJob.objects.filter(idempotency_key__in=[key for key in idempotency_keys if key])
+    }
+    jobs_by_coalesce_key: Dict[str, CommandJob] = {
+        job.coalesce_key: job
+        for job in CommandJob.objects.filter(
+            coalesce_key__in=[key for key in coalesce_keys if key], status__in=["queued", "running"])
+    }
+    if expire_stale_jobs([*jobs_by_idempotency_key.values(), *jobs_by_coalesce_key.values()]):
+        jobs_by_coalesce_key = {key: job for key, job in jobs_by_coalesce_key.items() if not job.done}
+    executor = get_executor()
+    results: List[Dict] = []
+    new_jobs: List[CommandJob] = []
+    reserved: List[CommandJob] = []  # the thread jobs taking a place of the executor, released unless submitted
+    try:
+        for call, idempotency_key, coalesce_key, request_key in zip(
+                calls, idempotency_keys, coalesce_keys, request_keys):
+            job = jobs_by_idempotency_key.get(idempotency_key) if idempotency_key else None
+            if job is not None:
+                try:
+                    _check_idempotency_key(job, request_key)
+                except IdempotencyKeyConflict as error:
+                    results.append({"job_id": None, "error": str(error)})
+                    continue
+            else:
+                job = jobs_by_coalesce_key.get(coalesce_key) if coalesce_key else None
+            if job is not None:
+                results.append({"job_id": job.job_id, "coalesced": True})
+                continue
+            job = CommandJob(
+                    command=call["command"], using=call["using"], args=call["args"], kwargs=call["kwargs"],
+                    idempotency_key=idempotency_key, coalesce_key=coalesce_key)
+            if call["using"] == "thread":
+                try:
+                    executor.reserve(call["command"])
+                except JobQueueFull as error:
+                    results.append({"job_id": None, "error": str(error)})
+                    continue
+                reserved.append(job)
+            new_jobs.append(job)
+            if idempotency_key:
+                jobs_by_idempotency_key[idempotency_key] = job
+            if coalesce_key:
+                jobs_by_coalesce_key[coalesce_key] = job
+            results.append({"job_id": job.job_id, "coalesced": False})
+        try:
+            with transaction.atomic():
+                CommandJob.objects.bulk_create(new_jobs)
+        except IntegrityError:
+            LOGGER.info("the jobs are created by another request, start them one by one")
+        else:
+            _dispatch(new_jobs, executor, reserved)
+            return results
+    finally:
+        executor.release_jobs(reserved)
+    return [_start_one(call) for call in calls]
+
+
+def _start_one(call: Dict) -> Dict:
+    try:
+        job_id, created = start_job(
+                call["command"], call["using"], call["args"], call["kwargs"],
+                idempotency_key=call["idempotency_key"], coalesce=call["coalesce"])
+    except (JobQueueFull, IdempotencyKeyConflict) as error:
+        return {"job_id": None, "error": str(error)}
+    return {"job_id": job_id, "coalesced": not created}
+
+
+def _dispatch(jobs: List[CommandJob], executor: CommandExecutor, reserved: List[CommandJob]) -> None:
+    # pylint: disable=import-outside-toplevel
+    from celery import group
+    from .tasks import async_call_command
+    while reserved:
+        # submit_job releases the place itself if it fails
+        executor.submit_job(reserved.pop())
+    celery_jobs = [job for job in jobs if job.using == "celery"]
+    if celery_jobs:
+        group(
+            async_call_command.s(job.command, job.using, job.args, job.kwargs, job_id=job.job_id)
+            for job in celery_jobs
+        ).apply_async()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+locks used by UniqueCommand
+"""
+
+
+import hashlib
+import logging
+import os
+import socket
+import threading
+import uuid
+from typing import Optional
+
+from django.db import DEFAULT_DB_ALIAS, NotSupportedError, connections
+
+from django_commands.types import RedisClient
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RedisLock:
+    """
+    a lock of SET key NX PX, a heartbeat thread renews it every timeout / 3 seconds.
+    if the process crashes, the lock expires after timeout seconds.
+
+    every time the lock is acquired, the fencing token (INCR <key>:fencing) increases,
+    pass it to the storage you write so it can reject the writes of an older owner.
+    if the lock can not be renewed, lost is set and the heartbeat stops.
+
+    keys:
+        <key>: the owner of the lock
+        <key>:fencing: the last fencing token
+    """
+
+    ACQUIRE_SCRIPT = """
+    if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+        return redis.call('INCR', KEYS[2])
+    end
+    return false
+    """
+    RENEW_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis: RedisClient, key: str, timeout: float = 10):
+        self.redis = redis
+        self.key = key
+        self.fencing_key = f"{key}:fencing"
+        self.timeout = timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.fencing_token: Optional[int] = None
+        self.lost = False
+        self._acquire_script = redis.register_script(self.ACQUIRE_SCRIPT)
+        self._renew_script = redis.register_script(self.RENEW_SCRIPT)
+        self._release_script = redis.register_script(self.RELEASE_SCRIPT)
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def acquire(self) -> bool:
+        """
+        try to acquire the lock without blocking
+        """
+        token = self._acquire_script(
+                keys=[self.key, self.fencing_key], args=[self.owner, int(self.timeout * 1000)])
+        if not token:
+            return False
+        self.fencing_token = int(token)
+        self.lost = False
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._keep_heartbeat, name=f"{self.key}:heartbeat", daemon=True)
+        self._thread.start()
+        return True
+
+    def release(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if not self._release_script(keys=[self.key], args=[self.owner]):
+            LOGGER.warning("lock %s was not owned by %s when released", self.key, self.owner)
+
+    def renew(self) -> bool:
+        return bool(self._renew_script(keys=[self.key], args=[self.owner, int(self.timeout * 1000)]))
+
+    def _keep_heartbeat(self) -> None:
+        while not self._stopped.wait(self.timeout / 3):
+            try:
+                renewed = self.renew()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                LOGGER.exception(error)
+                continue
+            if not renewed:
+                LOGGER.error("lock %s is lost by %s", self.key, self.owner)
+                self.lost = True
+                return
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args) -> None:
+        if self._thread is not None:
+            self.release()
+
+
+class AdvisoryLock:
+    """
+    a postgresql session level advisory lock pg_try_advisory_lock(<64 bit hash of the name>)
+    on a dedicated connection, the lock is released when the connection is closed or the session dies.
+    """
+
+    def __init__(self, name: str, using: str = DEFAULT_DB_ALIAS):
+        self.name = name
+        self.using = using
+        self.key = self.get_key(name)
+        self.connection = None
+
+    @staticmethod
+    def get_key(name: str) -> int:
+        """
+        the signed 64 bit key of the name
+        """
+        digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+    def acquire(self) -> bool:
+        """
+        try to acquire the lock without blocking
+        """
+        connection = connections.create_connection(self.using)
+        if connection.vendor != "postgresql":
+            raise NotSupportedError("advisory lock is only supported by postgresql")
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", [self.key])
+                acquired = cursor.fetchone()[0]
+        except Exception:
+            connection.close()
+            raise
+        if not acquired:
+            connection.close()
+            return False
+        self.connection = connection
+        return True
+
+    def release(self) -> None:
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [self.key])
+        finally:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+delete the old CommandLog in batches and roll them up into CommandLogRollup
+
+settings:
+    DJANGO_COMMANDS_LOG_RETENTION = datetime.timedelta(days=30)  # keep the logs of the last 30 days
+    DJANGO_COMMANDS_LOG_RETENTION_BY_NAME = {"<unique name>": datetime.timedelta(days=1)}
+"""
+
+
+import datetime
+import logging
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from django_commands.models import CommandLog, CommandLogRollup
+
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_RETENTION = datetime.timedelta(days=30)
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument(
+                "--batch-size", type=int, default=1000,
+                help="how many logs are deleted in one transaction")
+        parser.add_argument(
+                "--no-rollup", action="store_false", dest="rollup",
+                help="delete the logs without rolling them up")
+
+    def handle(self, *args, batch_size=1000, rollup=True, **kwargs):
+        now = timezone.now()
+        retention_by_name: Dict[str, datetime.timedelta] = getattr(
+                settings, "DJANGO_COMMANDS_LOG_RETENTION_BY_NAME", {})
+        retention = getattr(settings, "DJANGO_COMMANDS_LOG_RETENTION", DEFAULT_RETENTION)
+        deleted = 0
+        for name, name_retention in retention_by_name.items():
+            queryset = CommandLog.objects.filter(name=name, create_datetime__lt=now - name_retention)
+            deleted += self.prune(queryset, batch_size, rollup)
+        queryset = CommandLog.objects.filter(
+                create_datetime__lt=now - retention).exclude(name__in=list(retention_by_name))
+        deleted += self.prune(queryset, batch_size, rollup)
+        LOGGER.info("%d command logs are pruned", deleted)
+
+    def prune(self, queryset: QuerySet, batch_size: int, rollup: bool) -> int:
+        """
+        delete the logs of the queryset in the order of pk, batch_size logs per transaction.
+        every batch starts after the last pk of the previous one, so the pruned range is not scanned again
+        """
+        deleted = 0
+        last_pk = None
+        while True:
+            batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            rows = list(batch.order_by("pk").values_list(
+                "pk", "name", "status", "create_datetime", "update_datetime", "duration")[:batch_size])
+            if not rows:
+                return deleted
+            last_pk = rows[-1][0]
+            with transaction.atomic():
+                if rollup:
+                    self.rollup(rows)
+                CommandLog.objects.filter(pk__in=[row[0] for row in rows]).delete()
+            deleted += len(rows)
+            LOGGER.debug("%d command logs are pruned, last pk: %s", deleted, last_pk)
+
+    def rollup(self, rows: List[Tuple]) -> None:
+        """
+        add the count and duration of the rows into CommandLogRollup
+        """
+        stats: Dict[Tuple[str, datetime.datetime, str], List] = {}
+        for _, name, status, create_datetime, update_datetime, saved_duration in rows:
+            hour = create_datetime.replace(minute=0, second=0, microsecond=0)
+            duration = saved_duration
+            if duration is None:
+                duration = (update_datetime - create_datetime).total_seconds()
+            stat = stats.setdefault((name, hour, status), [0, 0.0, duration, duration])
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = min(stat[2], duration)
+            stat[3] = max(stat[3], duration)
+        for (name, hour, status), (count, total, minimum, maximum) in stats.items():
+            instance, _ = CommandLogRollup.objects.select_for_update().get_or_create(
+                    name=name, hour=hour, status=status)
+            instance.count += count
+            instance.total_duration += total
+            instance.min_duration = minimum if instance.min_duration is None else min(instance.min_duration, minimum)
+            instance.max_duration = maximum if instance.max_duration is None else max(instance.max_duration, maximum)
+            instance.save()
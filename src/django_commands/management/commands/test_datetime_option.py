@@ -13,5 +13,4 @@ class Command(BaseCommand):
         parser.add_argument("datetime", nargs="+", type=datetime_type)
 
     def handle(self, *args, **kwargs):
-        print(kwargs["datetime"])
-        pass
+        self.stdout.write(str(kwargs["datetime"]))
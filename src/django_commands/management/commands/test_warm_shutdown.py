@@ -4,7 +4,6 @@
 
 
 import os
-import time
 
 from django.core.management.base import BaseCommand
 from django_commands.mixins import WarmShutdownMixin
@@ -18,5 +17,7 @@ class Command(WarmShutdownMixin, BaseCommand):
                 print("stop")
                 return
             print(f"I'm running, try run `kill -TERM {os.getpid()}` in another terminal")
-            time.sleep(5)
+            if self.wait(5):
+                print("stop while waiting")
+                return
             print("finish one loop")
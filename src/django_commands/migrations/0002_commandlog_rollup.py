@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commands', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandLogRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+                ('hour', models.DateTimeField()),
+                ('status', models.TextField(choices=[('pending', 'pending'), ('skipped', 'skipped'), ('finished', 'finished')])),
+                ('count', models.PositiveBigIntegerField(default=0)),
+                ('total_duration', models.FloatField(default=0)),
+                ('min_duration', models.FloatField(null=True)),
+                ('max_duration', models.FloatField(null=True)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='commandlog',
+            name='django_comm_status_c6d84b_idx',
+        ),
+        migrations.AddIndex(
+            model_name='commandlog',
+            index=models.Index(fields=['status', 'name', 'create_datetime'], name='django_comm_status_7747e0_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='commandlogrollup',
+            unique_together={('name', 'hour', 'status')},
+        ),
+    ]
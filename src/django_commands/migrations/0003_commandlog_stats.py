@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commands', '0002_commandlog_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandlog',
+            name='cpu_time',
+            field=models.FloatField(help_text='cpu time of the process in seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='duration',
+            field=models.FloatField(help_text='wall time in seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='max_rss',
+            field=models.PositiveBigIntegerField(help_text='peak resident set size of the process in KB', null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='query_count',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='query_time',
+            field=models.FloatField(help_text='seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='rows',
+            field=models.PositiveBigIntegerField(help_text='how many rows are processed', null=True),
+        ),
+        migrations.AlterField(
+            model_name='commandlog',
+            name='status',
+            field=models.TextField(choices=[('pending', 'pending'), ('skipped', 'skipped'), ('finished', 'finished'), ('failed', 'failed')], default='pending'),
+        ),
+        migrations.AlterField(
+            model_name='commandlogrollup',
+            name='status',
+            field=models.TextField(choices=[('pending', 'pending'), ('skipped', 'skipped'), ('finished', 'finished'), ('failed', 'failed')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:48
+
+import django_commands.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commands', '0003_commandlog_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(default=django_commands.models.new_job_id, max_length=32, unique=True)),
+                ('command', models.TextField()),
+                ('using', models.TextField(default='local')),
+                ('args', models.JSONField(default=list)),
+                ('kwargs', models.JSONField(default=dict)),
+                ('status', models.TextField(choices=[('queued', 'queued'), ('running', 'running'), ('finished', 'finished'), ('failed', 'failed')], default='queued')),
+                ('output', models.TextField(blank=True, default='')),
+                ('error', models.TextField(blank=True, default='')),
+                ('create_datetime', models.DateTimeField(auto_now_add=True)),
+                ('start_datetime', models.DateTimeField(null=True)),
+                ('finish_datetime', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
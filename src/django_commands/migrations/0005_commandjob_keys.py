@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commands', '0004_commandjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandjob',
+            name='coalesce_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='commandjob',
+            name='idempotency_key',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='commandjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('idempotency_key__isnull', False)), fields=('idempotency_key',), name='django_commands_job_idempotency_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='commandjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running'])), fields=('coalesce_key',), name='django_commands_job_coalesce_key'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:09
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commands', '0005_commandjob_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandjob',
+            name='heartbeat_datetime',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
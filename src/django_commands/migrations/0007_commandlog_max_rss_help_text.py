@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commands', '0006_commandjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='commandlog',
+            name='max_rss',
+            field=models.PositiveBigIntegerField(help_text='peak resident set size of the whole process since it started in KB (getrusage ru_maxrss), not of this run', null=True),
+        ),
+    ]
@@ -4,8 +4,21 @@
 
 # pylint: disable=too-few-public-methods
 
+import contextlib
 import logging
 import signal
+import sys
+import threading
+import time
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import connections
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
 
 
 LOGGER = logging.getLogger(__name__)
@@ -29,14 +42,171 @@ class WarmShutdownMixin:
         if self.need_stop:
             return
 
-    in your command
+    in your command.
+    use `self.wait(seconds)` instead of `time.sleep(seconds)`, it returns True at once
+    when the command receives the TERM signal.
+    the signal handler is only installed when the command runs in the main thread.
     """
-    need_stop = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # `need_stop = False` of the old versions would hide the property
+        if cls.__dict__.get("need_stop") is False:
+            delattr(cls, "need_stop")
+
+    @property
+    def _stop_event(self) -> threading.Event:
+        # created lazily, so the subclasses which don't call super().__init__ work
+        event = self.__dict__.get("_need_stop_event")
+        if event is None:
+            event = self.__dict__.setdefault("_need_stop_event", threading.Event())
+        return event
+
+    @property
+    def need_stop(self) -> bool:
+        return self._stop_event.is_set()
+
+    @need_stop.setter
+    def need_stop(self, value: bool) -> None:
+        if value:
+            self._stop_event.set()
+        else:
+            self._stop_event.clear()
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """
+        sleep timeout seconds or until need_stop, return need_stop
+        """
+        if timeout is not None and timeout <= 0:
+            return self.need_stop
+        return self._stop_event.wait(timeout)
 
     def execute(self, *args, **kwargs):
-        signal.signal(signal.SIGTERM, self.handle_signal)
-        super().execute(*args, **kwargs)
+        if threading.current_thread() is not threading.main_thread():
+            return super().execute(*args, **kwargs)
+        previous = signal.signal(signal.SIGTERM, self.handle_signal)
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
 
     def handle_signal(self, signalnum, handler):  # pylint: disable=unused-argument
         LOGGER.info("receive stop signal")
         self.need_stop = True
+
+
+class RunStatsMixin:
+    """
+    record the wall time, cpu time, max_rss (the peak rss of the process so far in KB, not of the run),
+    query count and time, rows and status
+    (finished/failed) of every run into CommandLog, the logs are saved in one bulk insert at exit.
+
+    RECORD_STATS = None  # None means settings.DJANGO_COMMANDS_RECORD_STATS (default False)
+
+    a run is one execute, or one handle of the looping commands.
+    call self.add_rows(count) in handle to record how many rows are processed.
+    only the queries in the thread of the command are counted.
+    """
+    RECORD_STATS: Optional[bool] = None
+    STATS_BUFFER_SIZE = 1000  # save the logs before exit if there are so many logs
+    _stats_logs: Optional[List] = None
+
+    def execute(self, *args, **kwargs):
+        with self.recording_stats():
+            return super().execute(*args, **kwargs)
+
+    def get_log_name(self) -> str:
+        return f"{self.__class__.__module__}.{self.__class__.__name__}"
+
+    def should_record_stats(self) -> bool:
+        if self.RECORD_STATS is None:
+            return getattr(settings, "DJANGO_COMMANDS_RECORD_STATS", False)
+        return self.RECORD_STATS
+
+    def add_rows(self, count: int) -> None:
+        if self._stats_logs is not None:
+            self._stats_rows += count
+
+    @contextlib.contextmanager
+    def recording_stats(self, log=None):
+        """
+        record the stats of the block, set them to log (without saving) if log is given
+        """
+        if not self.should_record_stats() or self._stats_logs is not None:
+            yield
+            return
+        self._stats_logs = []
+        self._stats_queries = [0, 0.0]
+        self._stats_rows = 0
+        self._stats_runs = 0
+        self._stats_start = self._get_stats_snapshot()
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(self._count_query))
+                try:
+                    yield
+                except BaseException:
+                    self.record_run("failed", log=log)
+                    raise
+                if log is not None or not self._stats_runs:
+                    self.record_run("finished", log=log)
+        finally:
+            self._save_stats_logs()
+            self._stats_logs = None
+
+    def record_run(self, status: str, log=None) -> None:
+        """
+        record the stats since the last run
+        """
+        if self._stats_logs is None:
+            return
+        # pylint: disable=import-outside-toplevel
+        from django_commands.models import CommandLog
+        snapshot = self._get_stats_snapshot()
+        log = log or CommandLog(name=self.get_log_name())
+        log.status = status
+        log.duration = snapshot[0] - self._stats_start[0]
+        log.cpu_time = snapshot[1] - self._stats_start[1]
+        log.max_rss = self._get_max_rss()
+        log.query_count = snapshot[2] - self._stats_start[2]
+        log.query_time = snapshot[3] - self._stats_start[3]
+        log.rows = self._stats_rows
+        self._stats_start = snapshot
+        self._stats_rows = 0
+        self._stats_runs += 1
+        if log.pk is None:
+            self._stats_logs.append(log)
+            if len(self._stats_logs) >= self.STATS_BUFFER_SIZE:
+                self._save_stats_logs()
+
+    def _save_stats_logs(self) -> None:
+        if not self._stats_logs:
+            return
+        # pylint: disable=import-outside-toplevel
+        from django_commands.models import CommandLog
+        try:
+            CommandLog.objects.bulk_create(self._stats_logs)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            LOGGER.exception(error)
+        self._stats_logs = []
+
+    def _count_query(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self._stats_queries[0] += 1
+            self._stats_queries[1] += time.monotonic() - start
+
+    def _get_stats_snapshot(self):
+        return (time.monotonic(), time.process_time(), *self._stats_queries)
+
+    @staticmethod
+    def _get_max_rss() -> Optional[int]:
+        if resource is None:
+            return None
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":  # bytes
+            return max_rss // 1024
+        return max_rss
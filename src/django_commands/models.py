@@ -1,22 +1,134 @@
+import uuid
+from typing import Dict, Optional, Sequence
+
 from django.db import models
+from django.utils import timezone
+
+from django_commands.utils import percentile
 
 # Create your models here.
 
 
+class CommandLogQuerySet(models.QuerySet):
+
+    def get_duration_percentiles(
+            self, percents: Sequence[float] = (50, 95, 99)) -> Dict[str, Dict[str, Optional[float]]]:
+        """
+        {name: {"count": 10, "p50": 0.1, "p95": 0.3, "p99": 0.5}} of the logs with duration
+        """
+        durations: Dict[str, list] = {}
+        for name, duration in self.filter(duration__isnull=False).values_list("name", "duration").iterator():
+            durations.setdefault(name, []).append(duration)
+        result = {}
+        for name, values in durations.items():
+            result[name] = {"count": len(values)}
+            for percent in percents:
+                result[name][f"p{percent}"] = percentile(values, percent)
+        return result
+
+
 class CommandLog(models.Model):
+    """
+    the duration, cpu_time, max_rss, query_count, query_time and rows
+    are recorded by django_commands.mixins.RunStatsMixin
+    """
 
     STATUS_CHOICES = (
         ("pending", "pending"),
         ("skipped", "skipped"),
         ("finished", "finished"),
+        ("failed", "failed"),
     )
 
     name = models.TextField()
     status = models.TextField(choices=STATUS_CHOICES, default="pending")
     create_datetime = models.DateTimeField(auto_now_add=True)
     update_datetime = models.DateTimeField(auto_now=True)
+    duration = models.FloatField(null=True, help_text="wall time in seconds")
+    cpu_time = models.FloatField(null=True, help_text="cpu time of the process in seconds")
+    max_rss = models.PositiveBigIntegerField(null=True, help_text=(
+        "peak resident set size of the whole process since it started in KB (getrusage ru_maxrss), "
+        "not of this run"))
+    query_count = models.PositiveIntegerField(null=True)
+    query_time = models.FloatField(null=True, help_text="seconds")
+    rows = models.PositiveBigIntegerField(null=True, help_text="how many rows are processed")
+
+    objects = CommandLogQuerySet.as_manager()
 
     class Meta:
         indexes = [
-            models.Index(fields=["status", "name"])
+            models.Index(fields=["status", "name", "create_datetime"])
         ]
+
+
+class CommandLogRollup(models.Model):
+    """
+    the count and duration (in seconds, update_datetime - create_datetime if not recorded)
+    of the pruned CommandLog per name, per hour and per status
+    """
+
+    name = models.TextField()
+    hour = models.DateTimeField()
+    status = models.TextField(choices=CommandLog.STATUS_CHOICES)
+    count = models.PositiveBigIntegerField(default=0)
+    total_duration = models.FloatField(default=0)
+    min_duration = models.FloatField(null=True)
+    max_duration = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = [("name", "hour", "status")]
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+class CommandJob(models.Model):
+    """
+    a command called by the api, the stdout, stderr and log records of the command are appended to output
+
+    the jobs with the same idempotency_key are the same job.
+    only one job of a coalesce_key (hash of the command, args and kwargs) can be queued or running.
+    a running job refreshes heartbeat_datetime, see django_commands.jobs.expire_stale_jobs
+    """
+
+    STATUS_CHOICES = (
+        ("queued", "queued"),
+        ("running", "running"),
+        ("finished", "finished"),
+        ("failed", "failed"),
+    )
+    DONE_STATUS = ("finished", "failed")
+
+    job_id = models.CharField(max_length=32, unique=True, default=new_job_id)
+    command = models.TextField()
+    using = models.TextField(default="local")
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    status = models.TextField(choices=STATUS_CHOICES, default="queued")
+    output = models.TextField(blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    create_datetime = models.DateTimeField(auto_now_add=True)
+    start_datetime = models.DateTimeField(null=True)
+    finish_datetime = models.DateTimeField(null=True)
+    idempotency_key = models.TextField(null=True, blank=True)
+    coalesce_key = models.CharField(max_length=64, null=True, blank=True)
+    heartbeat_datetime = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["idempotency_key"],
+                condition=models.Q(idempotency_key__isnull=False),
+                name="django_commands_job_idempotency_key",
+            ),
+            models.UniqueConstraint(
+                fields=["coalesce_key"],
+                condition=models.Q(status__in=["queued", "running"]),
+                name="django_commands_job_coalesce_key",
+            ),
+        ]
+
+    @property
+    def done(self) -> bool:
+        return self.status in self.DONE_STATUS
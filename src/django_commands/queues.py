@@ -0,0 +1,592 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+redis queues used by WaitCommand
+"""
+
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import weakref
+from typing import AsyncGenerator, Dict, List, NamedTuple, Optional, Tuple
+
+import redis.asyncio
+from django.conf import settings
+from redis.exceptions import ResponseError
+
+from django_commands.types import RedisClient
+from django_commands.utils import iter_batches
+
+
+LOGGER = logging.getLogger(__name__)
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, redis.asyncio.Redis]]" = (
+    weakref.WeakKeyDictionary()
+)
+_ASYNC_CLOSERS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncGenerator]" = weakref.WeakKeyDictionary()
+
+
+def get_async_redis_connection(alias: str = "default") -> redis.asyncio.Redis:
+    """
+    a redis.asyncio client connecting to the (first) LOCATION of the django_redis cache with its OPTIONS:
+    USERNAME, PASSWORD, SOCKET_TIMEOUT, SOCKET_CONNECT_TIMEOUT, CONNECTION_POOL_KWARGS (e.g. the ssl options
+    of a rediss:// url) and REDIS_CLIENT_KWARGS. the sync CONNECTION_POOL_CLASS and PARSER_CLASS are ignored.
+    the client is shared in the running event loop and closed when the loop shuts down its async generators
+    (asyncio.run does), or by close_async_redis_connections
+    """
+    loop = asyncio.get_running_loop()
+    clients = _ASYNC_CLIENTS.get(loop)
+    if clients is None:
+        clients = _ASYNC_CLIENTS[loop] = {}
+        closer = _ASYNC_CLOSERS[loop] = _close_at_shutdown(clients)
+        # run the generator to its yield, so it's finalized by loop.shutdown_asyncgens
+        loop.create_task(closer.__anext__())
+    if alias not in clients:
+        clients[alias] = _create_async_client(settings.CACHES[alias])
+    return clients[alias]
+
+
+def _create_async_client(config: Dict) -> redis.asyncio.Redis:
+    location = config["LOCATION"]
+    if isinstance(location, str):
+        location = location.split(",")
+    options = config.get("OPTIONS", {})
+    kwargs = dict(options.get("CONNECTION_POOL_KWARGS", {}))
+    for option, argument in [
+        ("USERNAME", "username"),
+        ("PASSWORD", "password"),
+        ("SOCKET_TIMEOUT", "socket_timeout"),
+        ("SOCKET_CONNECT_TIMEOUT", "socket_connect_timeout"),
+    ]:
+        if options.get(option):
+            kwargs[argument] = options[option]
+    pool = redis.asyncio.ConnectionPool.from_url(location[0], **kwargs)
+    return redis.asyncio.Redis(connection_pool=pool, **options.get("REDIS_CLIENT_KWARGS", {}))
+
+
+async def close_async_redis_connections() -> None:
+    """
+    close the clients of the running event loop, e.g. in the lifespan shutdown of an ASGI application
+    """
+    loop = asyncio.get_running_loop()
+    _ASYNC_CLOSERS.pop(loop, None)
+    await _close_clients(_ASYNC_CLIENTS.pop(loop, {}))
+
+
+async def _close_at_shutdown(clients: Dict[str, redis.asyncio.Redis]) -> AsyncGenerator:
+    try:
+        yield
+    finally:
+        await _close_clients(clients)
+
+
+async def _close_clients(clients: Dict[str, redis.asyncio.Redis]) -> None:
+    while clients:
+        _, client = clients.popitem()
+        try:
+            await client.aclose(close_connection_pool=True)
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.exception(error)
+
+
+class Task(NamedTuple):
+    """
+    a popped task, entry_id is the id of the stream entry
+    """
+    task_id: bytes
+    payload: Optional[dict] = None
+    entry_id: Optional[bytes] = None
+
+
+class ListQueue:
+    """
+    a redis list, the tasks are removed from redis once they are popped
+
+    if deduplicate, a task id waiting in the queue will not be pushed again.
+    if delayed, the tasks pushed with run_at wait in a sorted set and are moved into the queue
+    when they are due by the TIME of redis, the consumer blocks exactly until the next due task.
+    the delayed tasks need redis >= 6.2 (ZADD LT), so does the reliable queue (BLMOVE, LMOVE).
+    if a delayed task earlier than all the others is pushed while the queue is empty,
+    an empty task id is pushed to wake up the blocked consumer, it's never returned by pop.
+    the due tasks are moved, popped and removed from the deduplicate set in one lua script.
+
+    keys:
+        <key>: the queue
+        <key>:queued: set of the task ids in the queue (deduplicate)
+        <key>:delayed: sorted set of task id => due timestamp in milliseconds (delayed)
+    """
+
+    DRAIN_SCRIPT = """
+    local next_due = false
+    if ARGV[4] == '1' then
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+        local due = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now, 'LIMIT', 0, 1000)
+        for _, task_id in ipairs(due) do
+            redis.call('ZREM', KEYS[4], task_id)
+            if ARGV[3] ~= '1' or redis.call('SADD', KEYS[3], task_id) == 1 then
+                redis.call('RPUSH', KEYS[1], task_id)
+            end
+        end
+        local earliest = redis.call('ZRANGE', KEYS[4], 0, 0, 'WITHSCORES')[2]
+        if earliest then
+            next_due = tostring(tonumber(earliest) - now)
+        end
+    end
+    local task_ids = {}
+    if tonumber(ARGV[1]) > 0 then
+        for _, task_id in ipairs(redis.call('LPOP', KEYS[1], ARGV[1]) or {}) do
+            if task_id ~= '' then
+                table.insert(task_ids, task_id)
+            end
+        end
+    end
+    if #task_ids > 0 then
+        if ARGV[5] == '1' then
+            redis.call('RPUSH', KEYS[2], unpack(task_ids))
+        end
+        if ARGV[3] == '1' then
+            redis.call('SREM', KEYS[3], unpack(task_ids))
+        end
+    end
+    if ARGV[6] and ARGV[3] == '1' then
+        redis.call('SREM', KEYS[3], ARGV[6])
+    end
+    if ARGV[2] == '1' then
+        redis.call('DEL', KEYS[1], KEYS[3])
+    end
+    return {task_ids, next_due}
+    """
+    PUSH_SCRIPT = """
+    for _, task_id in ipairs(ARGV) do
+        if redis.call('SADD', KEYS[2], task_id) == 1 then
+            redis.call('RPUSH', KEYS[1], task_id)
+        end
+    end
+    """
+    DELAY_SCRIPT = """
+    local earliest = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')[2]
+    local members = {}
+    for index = 2, #ARGV do
+        table.insert(members, ARGV[1])
+        table.insert(members, ARGV[index])
+    end
+    redis.call('ZADD', KEYS[2], 'LT', unpack(members))
+    if (not earliest or tonumber(ARGV[1]) < tonumber(earliest)) and redis.call('LLEN', KEYS[1]) == 0 then
+        redis.call('RPUSH', KEYS[1], '')
+    end
+    """
+    WAKE_UP = b""
+    reliable = False
+
+    def __init__(
+            self, redis: RedisClient, key: str, squash: bool = False,
+            deduplicate: bool = False, delayed: bool = False):
+        self.redis = redis
+        self.key = key
+        self.squash = squash
+        self.deduplicate = deduplicate
+        self.delayed = delayed
+        self.queued_key = f"{key}:queued"
+        self.delayed_key = f"{key}:delayed"
+        self.processing_key = f"{key}:processing"
+        self._drain_script = redis.register_script(self.DRAIN_SCRIPT)
+        self._push_script = redis.register_script(self.PUSH_SCRIPT)
+        self._delay_script = redis.register_script(self.DELAY_SCRIPT)
+
+    def start(self) -> None:
+        """
+        called before the first pop
+        """
+        return
+
+    def close(self) -> None:
+        """
+        called when the consumer exits
+        """
+        return
+
+    def maintain(self) -> None:
+        """
+        called in every loop of the consumer
+        """
+        return
+
+    def pop(self, count: int, timeout: float) -> List[Task]:
+        """
+        pop at most count tasks, block at most timeout seconds if there is no task
+        """
+        task_ids, next_due = self._drain(count)
+        if not task_ids:
+            if next_due is not None:
+                timeout = max(min(timeout, next_due), 0.01)
+            task_id = self._block(timeout)
+            if task_id is None:
+                return []
+            if task_id == self.WAKE_UP:
+                # an earlier delayed task is pushed, drain it in the next pop
+                self.ack([Task(task_id)])
+                return []
+            task_ids = [task_id, *self._drain(count - 1, task_id)[0]]
+        return [Task(task_id) for task_id in task_ids]
+
+    def ack(self, tasks: List[Task]) -> None:
+        """
+        the tasks are handled successfully
+        """
+        return
+
+    def push(
+            self, task_ids: List[str],
+            payloads: Optional[List[Optional[dict]]] = None, chunk_size: int = 1000,
+            run_at: Optional[float] = None) -> None:
+        """
+        push the tasks in one pipeline, chunk_size tasks per command.
+        run_at is the timestamp when the tasks should run
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        self._fill_pipeline(pipeline, task_ids, payloads, chunk_size, run_at, self._push_script, self._delay_script)
+        pipeline.execute()
+
+    async def apush(
+            self, redis, task_ids: List[str],
+            payloads: Optional[List[Optional[dict]]] = None, chunk_size: int = 1000,
+            run_at: Optional[float] = None) -> None:
+        """
+        same as push, but use the redis.asyncio client
+        """
+        async with redis.pipeline(transaction=False) as pipeline:
+            script_calls = self._fill_pipeline(
+                    pipeline, task_ids, payloads, chunk_size, run_at,
+                    redis.register_script(self.PUSH_SCRIPT), redis.register_script(self.DELAY_SCRIPT))
+            for script_call in script_calls:
+                # the AsyncScript only queues the command into the pipeline
+                await script_call
+            await pipeline.execute()
+
+    def _fill_pipeline(self, pipeline, task_ids, payloads, chunk_size, run_at, push_script, delay_script) -> List:
+        """
+        the scripts are registered on the client of the pipeline, the pipeline loads them if needed.
+        return what the script calls return
+        """
+        script_calls = []
+        if payloads and any(payload is not None for payload in payloads):
+            raise ValueError("payload is only supported by the stream backend")
+        if run_at is not None and not self.delayed:
+            raise ValueError("set DELAYED_TASK = True to create delayed tasks")
+        for chunk in iter_batches(task_ids, chunk_size):
+            if run_at is not None:
+                # keep the earliest time if the task is already delayed
+                script_calls.append(delay_script(
+                    keys=[self.key, self.delayed_key], args=[run_at * 1000, *chunk], client=pipeline))
+            elif self.deduplicate:
+                script_calls.append(push_script(keys=[self.key, self.queued_key], args=chunk, client=pipeline))
+            else:
+                pipeline.rpush(self.key, *chunk)
+        return script_calls
+
+    def clear(self) -> None:
+        self.redis.delete(self.key, self.queued_key, self.delayed_key)
+
+    def info(self) -> Dict[str, Optional[int]]:
+        """
+        the backlog of the queue
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.llen(self.key)
+        pipeline.zcard(self.delayed_key)
+        length, delayed = pipeline.execute()
+        return {"length": length, "delayed": delayed}
+
+    def _block(self, timeout: float):
+        result = self.redis.blpop(self.key, timeout=timeout)
+        if result is None:
+            return None
+        return result[1]
+
+    def _drain(self, count: int, popped: Optional[bytes] = None) -> Tuple[List[bytes], Optional[float]]:
+        """
+        move the due tasks into the queue, lpop and squash in one round trip.
+        popped is the task popped by _block, it should be removed from the deduplicate set.
+        return the tasks and the seconds until the next due task (by the TIME of redis)
+        """
+        if not (self.reliable or self.deduplicate or self.delayed):
+            return self._drain_by_pipeline(count), None
+        if count <= 0 and not self.squash and popped is None:
+            return [], None
+        args = [
+            max(count, 0),
+            *("1" if flag else "0" for flag in (self.squash, self.deduplicate, self.delayed, self.reliable)),
+        ]
+        if popped is not None:
+            args.append(popped)
+        task_ids, next_due = self._drain_script(
+            keys=[self.key, self.processing_key, self.queued_key, self.delayed_key],
+            args=args,
+        )
+        return task_ids, float(next_due) / 1000 if next_due else None
+
+    def _drain_by_pipeline(self, count: int) -> List[bytes]:
+        if count <= 0 and not self.squash:
+            return []
+        pipeline = self.redis.pipeline(transaction=True)
+        if count > 0:
+            pipeline.lpop(self.key, count)
+        if self.squash:
+            pipeline.delete(self.key)
+        results = pipeline.execute()
+        if count > 0:
+            return results[0] or []
+        return []
+
+
+class ReliableListQueue(ListQueue):
+    """
+    the popped tasks are moved into a processing list of the consumer and removed after ack.
+    every consumer refreshes its heartbeat in a thread, the tasks in the processing list of a
+    consumer without heartbeat for `consumer_timeout` seconds will be moved back to the queue.
+
+    keys:
+        <key>: the queue
+        <key>:processing:<consumer>: tasks being handled by the consumer
+        <key>:consumers: sorted set of consumer => timestamp of the last heartbeat
+    """
+
+    HEARTBEAT_SCRIPT = """
+    local now = redis.call('TIME')
+    redis.call('ZADD', KEYS[1], now[1], ARGV[1])
+    """
+    RECOVER_SCRIPT = """
+    local now = tonumber(redis.call('TIME')[1])
+    local count = 0
+    for index = 3, #ARGV do
+        local heartbeat = redis.call('ZSCORE', KEYS[1], ARGV[index])
+        if heartbeat and tonumber(heartbeat) <= now - tonumber(ARGV[1]) then
+            local processing = KEYS[index + 1]
+            local task_id = redis.call('RPOP', processing)
+            while task_id do
+                if task_id ~= '' and (ARGV[2] ~= '1' or redis.call('SADD', KEYS[3], task_id) == 1) then
+                    redis.call('LPUSH', KEYS[2], task_id)
+                    count = count + 1
+                end
+                task_id = redis.call('RPOP', processing)
+            end
+            redis.call('ZREM', KEYS[1], ARGV[index])
+        end
+    end
+    return count
+    """
+
+    reliable = True
+
+    def __init__(
+            self, redis: RedisClient, key: str, squash: bool = False,
+            deduplicate: bool = False, delayed: bool = False, consumer_timeout: float = 60):
+        super().__init__(redis, key, squash, deduplicate, delayed)
+        self.consumer_timeout = consumer_timeout
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.consumers_key = f"{key}:consumers"
+        self.processing_prefix = f"{key}:processing:"
+        self.processing_key = self.processing_prefix + self.consumer
+        self._heartbeat_script = redis.register_script(self.HEARTBEAT_SCRIPT)
+        self._recover_script = redis.register_script(self.RECOVER_SCRIPT)
+        self._recovered_at = 0.0
+        self._stopped = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._keep_heartbeat, daemon=True)
+
+    def start(self) -> None:
+        self.heartbeat()
+        self.recover()
+        self._heartbeat_thread.start()
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._heartbeat_thread.is_alive():
+            self._heartbeat_thread.join()
+        if self.redis.llen(self.processing_key):
+            # leave the heartbeat so the tasks will be recovered by other consumers
+            LOGGER.warning("%s exits with unfinished tasks", self.consumer)
+            return
+        self.redis.zrem(self.consumers_key, self.consumer)
+
+    def maintain(self) -> None:
+        if time.monotonic() - self._recovered_at > self.consumer_timeout / 3:
+            self.recover()
+
+    def heartbeat(self) -> None:
+        self._heartbeat_script(keys=[self.consumers_key], args=[self.consumer])
+
+    def recover(self) -> int:
+        """
+        move the tasks of dead consumers back to the head of the queue,
+        a task already waiting in the queue is dropped if deduplicate
+        """
+        self._recovered_at = time.monotonic()
+        now, _ = self.redis.time()
+        dead = [
+            consumer.decode() if isinstance(consumer, bytes) else consumer
+            for consumer in self.redis.zrangebyscore(self.consumers_key, "-inf", now - self.consumer_timeout)
+        ]
+        if not dead:
+            return 0
+        # the script checks the heartbeat again, a consumer may come back in between
+        count = self._recover_script(
+            keys=[
+                self.consumers_key, self.key, self.queued_key,
+                *(self.processing_prefix + consumer for consumer in dead),
+            ],
+            args=[self.consumer_timeout, "1" if self.deduplicate else "0", *dead],
+        )
+        if count:
+            LOGGER.warning("recover %d tasks from dead consumers of %s", count, self.key)
+        return count
+
+    def ack(self, tasks: List[Task]) -> None:
+        pipeline = self.redis.pipeline(transaction=False)
+        for task in tasks:
+            pipeline.lrem(self.processing_key, 1, task.task_id)
+        pipeline.execute()
+
+    def _keep_heartbeat(self) -> None:
+        while not self._stopped.wait(self.consumer_timeout / 3):
+            try:
+                self.heartbeat()
+            except Exception as error:  # pylint: disable=broad-except
+                LOGGER.exception(error)
+
+    def _block(self, timeout: float):
+        return self.redis.blmove(self.key, self.processing_key, timeout, "LEFT", "RIGHT")
+
+
+class StreamQueue(ListQueue):
+    """
+    a redis stream consumed by a consumer group.
+    the entries are read with XREADGROUP (COUNT, BLOCK) and acknowledged with XACK.
+    an entry delivered but not acknowledged for `processing_timeout` seconds is treated as lost
+    (the consumer died) and claimed by another consumer with XAUTOCLAIM, so the timeout must be longer
+    than an entry can wait in the consumer and be handled, or it's handled twice.
+    if squash, the entries not delivered yet when a batch is read are delivered to this consumer
+    and acknowledged at once, the pending entries of other consumers are kept.
+    the stream is trimmed to about `maxlen` entries when a task is added.
+
+    keys:
+        <key>:stream: the stream, every entry has a task_id field and an optional json payload field
+    """
+
+    def __init__(
+            self, redis: RedisClient, key: str, squash: bool = False,
+            processing_timeout: float = 60, group: str = "default", maxlen: Optional[int] = 100000):
+        super().__init__(redis, key, squash)
+        self.stream_key = f"{key}:stream"
+        self.group = group
+        self.maxlen = maxlen
+        self.processing_timeout = processing_timeout
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._claimed: List[Task] = []
+        self._claim_start = "0-0"
+        self._claimed_at = 0.0
+
+    def start(self) -> None:
+        try:
+            self.redis.xgroup_create(self.stream_key, self.group, id="0", mkstream=True)
+        except ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+
+    def close(self) -> None:
+        pending = self.redis.xpending_range(
+            self.stream_key, self.group, min="-", max="+", count=1, consumername=self.consumer)
+        if pending:
+            LOGGER.warning("%s exits with unfinished tasks", self.consumer)
+            return
+        self.redis.xgroup_delconsumer(self.stream_key, self.group, self.consumer)
+
+    def maintain(self) -> None:
+        if self._claimed or time.monotonic() - self._claimed_at < self.processing_timeout / 3:
+            return
+        self._claimed_at = time.monotonic()
+        result = self.redis.xautoclaim(
+            self.stream_key, self.group, self.consumer,
+            min_idle_time=int(self.processing_timeout * 1000),
+            start_id=self._claim_start, count=100)
+        self._claim_start = result[0]
+        self._claimed = [self._to_task(entry_id, fields) for entry_id, fields in result[1] if fields]
+        if self._claimed:
+            LOGGER.warning("claim %d tasks from dead consumers of %s", len(self._claimed), self.stream_key)
+
+    def pop(self, count: int, timeout: float) -> List[Task]:
+        if self._claimed:
+            tasks, self._claimed = self._claimed[:count], self._claimed[count:]
+            return tasks
+        result = self.redis.xreadgroup(
+            self.group, self.consumer, {self.stream_key: ">"},
+            count=count, block=int(timeout * 1000))
+        if not result:
+            return []
+        if self.squash:
+            self._squash()
+        _, entries = result[0]
+        return [self._to_task(entry_id, fields) for entry_id, fields in entries]
+
+    def _squash(self, chunk_size: int = 1000) -> None:
+        while True:
+            result = self.redis.xreadgroup(self.group, self.consumer, {self.stream_key: ">"}, count=chunk_size)
+            entries = result[0][1] if result else []
+            if entries:
+                self.redis.xack(self.stream_key, self.group, *[entry_id for entry_id, _ in entries])
+            if len(entries) < chunk_size:
+                return
+
+    def ack(self, tasks: List[Task]) -> None:
+        if tasks:
+            self.redis.xack(self.stream_key, self.group, *[task.entry_id for task in tasks])
+
+    def _fill_pipeline(self, pipeline, task_ids, payloads, chunk_size, run_at, push_script, delay_script) -> List:
+        if run_at is not None:
+            raise ValueError("delayed task is only supported by the list backend")
+        payloads = payloads or [None] * len(task_ids)
+        for task_id, payload in zip(task_ids, payloads):
+            fields = {"task_id": task_id}
+            if payload is not None:
+                fields["payload"] = json.dumps(payload)
+            pipeline.xadd(self.stream_key, fields, maxlen=self.maxlen, approximate=True)
+        return []
+
+    def clear(self) -> None:
+        """
+        remove the entries but keep the stream and its consumer group for the running consumers
+        """
+        self.redis.xtrim(self.stream_key, maxlen=0, approximate=False)
+
+    def info(self) -> Dict[str, Optional[int]]:
+        """
+        the backlog of the group: length of the stream, pending (delivered but not acked) and
+        lag (not delivered yet, redis >= 7)
+        """
+        length = self.redis.xlen(self.stream_key)
+        if not length:
+            return {"length": 0, "pending": 0, "lag": 0}
+        for group in self.redis.xinfo_groups(self.stream_key):
+            name = group["name"]
+            if isinstance(name, bytes):
+                name = name.decode()
+            if name == self.group:
+                return {"length": length, "pending": group["pending"], "lag": group.get("lag")}
+        return {"length": length, "pending": 0, "lag": length}
+
+    @staticmethod
+    def _to_task(entry_id: bytes, fields: Dict[bytes, bytes]) -> Task:
+        payload = fields.get(b"payload")
+        return Task(
+            fields[b"task_id"],
+            json.loads(payload) if payload is not None else None,
+            entry_id,
+        )
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+a registry of the command classes and parsers of DJANGO_COMMANDS_ALLOW_REMOTE_CALL,
+it's built once in AppConfig.ready (and again when the setting is changed, e.g. override_settings)
+so the remote calls don't import the command and build the parser every time.
+
+call_command works the same as django.core.management.call_command,
+the commands not in the registry are called by django.core.management.call_command.
+"""
+
+
+import logging
+import threading
+from typing import Dict, Iterable, NamedTuple, Type
+
+from django.core import management
+from django.core.management.base import BaseCommand, CommandParser
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CommandEntry(NamedTuple):
+    command_class: Type[BaseCommand]
+    parser: CommandParser
+
+
+class CommandRegistry:
+
+    def __init__(self):
+        self.entries: Dict[str, CommandEntry] = {}
+        self.lock = threading.Lock()
+
+    def build(self, command_names: Iterable[str]) -> None:
+        """
+        load the commands, the commands which can not be loaded are skipped
+        """
+        for command_name in command_names:
+            try:
+                self.register(command_name)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                LOGGER.warning("can not load command %s: %s", command_name, error)
+
+    def rebuild(self, command_names: Iterable[str]) -> None:
+        """
+        drop the entries and load the commands again
+        """
+        with self.lock:
+            self.entries = {}
+        self.build(command_names)
+
+    def register(self, command_name: str) -> CommandEntry:
+        app_name = management.get_commands()[command_name]
+        if isinstance(app_name, BaseCommand):
+            command = app_name
+        else:
+            command = management.load_command_class(app_name, command_name)
+        entry = CommandEntry(command_class=type(command), parser=command.create_parser("", command_name))
+        with self.lock:
+            self.entries[command_name] = entry
+        return entry
+
+    def call_command(self, command_name: str, *args, **options):
+        """
+        a new instance of the cached command class is called by django.core.management.call_command
+        with the cached parser
+        """
+        entry = self.entries.get(command_name)
+        if entry is None:
+            return management.call_command(command_name, *args, **options)
+        command = entry.command_class()
+        command.create_parser = lambda prog_name, subcommand, **kwargs: entry.parser
+        return management.call_command(command, *args, **options)
+
+
+registry = CommandRegistry()
+
+
+def call_command(command_name: str, *args, **options):
+    return registry.call_command(command_name, *args, **options)
+
+
+@receiver(setting_changed)
+def rebuild_registry(setting, value, **kwargs):  # pylint: disable=unused-argument
+    if setting == "DJANGO_COMMANDS_ALLOW_REMOTE_CALL":
+        registry.rebuild(value or [])
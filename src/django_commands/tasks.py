@@ -4,12 +4,13 @@
 
 
 import logging
-from threading import Thread
-from typing import Literal
+from typing import Literal, Optional
 
-from django.core.management import call_command
 from celery import shared_task
 
+from .jobs import get_executor, run_job
+from .registry import call_command
+
 
 LOGGER = logging.getLogger(__name__)
 
@@ -18,18 +19,25 @@ LOGGER = logging.getLogger(__name__)
 def async_call_command(
         command: str,
         using: Literal["celery", "thread", "local"]="thread",
-        args=None, kwargs=None,
-    ) -> None:
+        args=None, kwargs=None, job_id: Optional[str] = None,
+    ) -> Optional[str]:
+    """
+    call the command, return the job id if using thread.
+    the thread jobs run in a bounded pool, JobQueueFull is raised if it's full, see django_commands.jobs
+    if job_id is given, the status and output of the celery task are saved into the CommandJob
+    """
     args = args or []
     kwargs = kwargs or {}
     if using == "celery":
         LOGGER.info("celery task started")
-        call_command(command, *args, **kwargs)
+        if job_id:
+            run_job(job_id, command, args, kwargs)
+        else:
+            call_command(command, *args, **kwargs)
         return
     if using == "thread":
         LOGGER.info("thread task started")
-        Thread(None, call_command, args=[command, *args], kwargs=kwargs).start()
-        return
+        return get_executor().submit(command, args, kwargs)
     if using == "local":
         LOGGER.info("local task started")
         call_command(command, *args, **kwargs)
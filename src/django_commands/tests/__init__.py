@@ -1,11 +1,32 @@
+import asyncio
+import datetime
+import io
 import logging
+import os
+import signal
+import threading
 import time
+from unittest import mock
 
-from django.test import TestCase
-from django_commands import models, utils
-from django_commands.models import CommandLog
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand, call_command
+from django.db import NotSupportedError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_commands import models, utils, views
+from django_commands.commands import DurationCommand, MultiProcessCommand, MultiTimesCommand, UniqueCommand
+from django_commands.exceptions import JobQueueFull
+from django_commands.jobs import CommandExecutor, get_coalesce_key
+from django_commands.locks import AdvisoryLock
+from django_commands.registry import CommandRegistry, registry
+from django_commands.models import CommandJob, CommandLog, CommandLogRollup
 from django_commands.tasks import async_call_command
-from django_commands.utils import get_middle_string, iter_large_queryset
+from django_commands.utils import (
+        get_middle_string, iter_large_queryset,
+        iter_keyset_boundaries, iter_keyset_chunks, keyset_range_q,
+        iter_pk_ranges, iter_histogram_ranges, split_histogram, iter_balanced_ranges, TaskStatistics,
+)
 
 from rest_framework.test import APIClient
 
@@ -19,6 +40,525 @@ class BisectTask(utils.Bisect):
         return (self.DATA[end] - self.DATA[start]) != end - start
 
 
+class SquareCommand(MultiProcessCommand):
+    EXECUTOR = "thread"
+    WORKER_DATABASES = []
+    lock = threading.Lock()
+    running = 0
+    max_running = 0  # how many tasks are handled at the same time at most
+
+    def get_tasks(self):
+        return list(range(100))
+
+    @classmethod
+    def handle_single_task(cls, task):
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+        time.sleep(0.01)
+        with cls.lock:
+            cls.running -= 1
+        return task * task
+
+    def reduce_results(self, accumulator, result):
+        return (accumulator or 0) + result
+
+
+class WorkerSquareCommand(SquareCommand):
+    setups: list = []
+    teardowns: list = []
+
+    @classmethod
+    def setup_worker(cls):
+        cls.setups.append(threading.get_ident())
+
+    @classmethod
+    def teardown_worker(cls):
+        cls.teardowns.append(threading.get_ident())
+
+    @classmethod
+    def handle_single_task(cls, task):
+        if task == 50:
+            raise ValueError("bad task")
+        return super().handle_single_task(task)
+
+
+class AsyncSquareCommand(SquareCommand):
+    EXECUTOR = "async"
+
+    def get_tasks(self):
+        return iter(range(100))
+
+    @classmethod
+    async def handle_single_task(cls, task):
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        await asyncio.sleep(0.01)
+        cls.running -= 1
+        return task * task
+
+
+class TestMultiProcessCommand(TestCase):
+
+    def test_thread_executor(self):
+        command = SquareCommand()
+        SquareCommand.max_running = 0
+        command.handle(jobs=20, chunk_size=1)
+        self.assertGreater(SquareCommand.max_running, 1)
+        self.assertLessEqual(SquareCommand.max_running, 20)
+        self.assertEqual(command.accumulator, sum(i * i for i in range(100)))
+        self.assertEqual(command.statistics.summary()["tasks"], 100)
+
+    def test_thread_worker(self):
+        command = WorkerSquareCommand()
+        with self.assertRaises(ValueError):
+            command.handle(jobs=4, chunk_size=1)
+        self.assertEqual(len(WorkerSquareCommand.setups), 4)
+        self.assertEqual(sorted(WorkerSquareCommand.setups), sorted(WorkerSquareCommand.teardowns))
+
+    def test_async_executor(self):
+        command = AsyncSquareCommand()
+        AsyncSquareCommand.max_running = 0
+        command.handle(jobs=50)
+        self.assertGreater(AsyncSquareCommand.max_running, 1)
+        self.assertLessEqual(AsyncSquareCommand.max_running, 50)
+        self.assertEqual(command.accumulator, sum(i * i for i in range(100)))
+
+
+class FakeClock:
+    """
+    time.monotonic, time.sleep and the wait of the command, sleeping only moves the clock
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds or 0, 0)
+
+    def wait(self, timeout):
+        self.sleep(timeout)
+        return False
+
+    def run(self, command, *args, **kwargs):
+        with mock.patch("time.monotonic", self.monotonic), mock.patch("time.sleep", self.sleep), \
+                mock.patch.object(command, "wait", self.wait):
+            call_command(command, *args, **kwargs)
+
+
+class TickCommand(MultiTimesCommand):
+    INTERVAL = 0.1
+    MAX_TIMES = 5
+
+    def __init__(self, *args, durations=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.durations = list(durations)
+        self.run_times = []
+
+    def handle(self, *args, **kwargs):
+        self.run_times.append(time.monotonic())
+        time.sleep(self.durations.pop(0) if self.durations else 0.05)
+
+
+class TestMultiTimesCommand(TestCase):
+
+    def test_fixed_ticks(self):
+        command = TickCommand()
+        FakeClock().run(command)
+        start = command.run_times[0]
+        for expected, run_time in zip([0, 0.1, 0.2, 0.3, 0.4], command.run_times):
+            self.assertAlmostEqual(run_time - start, expected)
+
+    def test_overrun(self):
+        command = TickCommand(durations=[0.25])
+        FakeClock().run(command)
+        start = command.run_times[0]
+        for expected, run_time in zip([0, 0.3, 0.4, 0.5, 0.6], command.run_times):
+            self.assertAlmostEqual(run_time - start, expected)
+        command = TickCommand(durations=[0.25])
+        command.OVERRUN = "catch_up"
+        FakeClock().run(command)
+        start = command.run_times[0]
+        for expected, run_time in zip([0, 0.25, 0.3, 0.35, 0.4], command.run_times):
+            self.assertAlmostEqual(run_time - start, expected)
+        command = TickCommand(durations=[0.25])
+        command.OVERRUN = "immediate"
+        FakeClock().run(command)
+        start = command.run_times[0]
+        for expected, run_time in zip([0, 0.25, 0.35, 0.45, 0.55], command.run_times):
+            self.assertAlmostEqual(run_time - start, expected)
+
+
+class PollCommand(MultiTimesCommand):
+    INTERVAL = 0.05
+    ADAPTIVE_INTERVAL = True
+    MAX_INTERVAL = 0.2
+    MAX_TIMES = 7
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results = [3, True, 0, False, 0, 0, 2]
+        self.intervals = []
+
+    def handle(self, *args, **kwargs):
+        if self.run_cnt > 1:
+            self.intervals.append(self.current_interval)
+        return self.results.pop(0)
+
+
+class ListCommand(MultiTimesCommand):
+    INTERVAL = 0
+    MAX_TIMES = 3
+
+    def handle(self, *args, **kwargs):
+        return [1, 2] if self.run_cnt == 1 else -1
+
+
+class TestAdaptiveInterval(TestCase):
+
+    def test_ignore_other_output(self):
+        command = ListCommand()
+        call_command(command)
+        metrics = command.get_metrics()
+        self.assertEqual(metrics["runs"], 3)
+        self.assertEqual(metrics["items"], 0)
+
+    def test_backoff(self):
+        command = PollCommand()
+        clock = FakeClock()
+        start = clock.now
+        clock.run(command)
+        self.assertEqual(command.intervals, [0, 0, 0.05, 0.1, 0.2, 0.2])
+        self.assertAlmostEqual(clock.now - start, 0.55)
+        metrics = command.get_metrics()
+        self.assertEqual(metrics["runs"], 7)
+        self.assertEqual(metrics["idle_runs"], 4)
+        self.assertEqual(metrics["items"], 5)
+        self.assertEqual(metrics["current_interval"], 0)
+
+
+class IdleDurationCommand(DurationCommand):
+    INTERVAL = 10
+
+    def handle(self, *args, **kwargs):
+        return
+
+
+class LegacyStopCommand(MultiTimesCommand):
+    """
+    the old style: need_stop is a class attribute and BaseCommand.__init__ is called directly
+    """
+    need_stop = False
+    INTERVAL = 10
+    MAX_TIMES = 3
+
+    def __init__(self, *args, **kwargs):  # pylint: disable=super-init-not-called
+        BaseCommand.__init__(self, *args, **kwargs)
+        self.runs = 0
+
+    def handle(self, *args, **kwargs):
+        self.runs += 1
+
+
+class TestWarmShutdown(TestCase):
+
+    def test_legacy_need_stop(self):
+        command = LegacyStopCommand()
+        self.assertFalse(command.need_stop)
+        threading.Timer(0.1, setattr, (command, "need_stop", True)).start()
+        start = time.monotonic()
+        call_command(command)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(command.runs, 1)
+
+    def test_stop_while_waiting(self):
+        command = TickCommand()
+        command.INTERVAL = 10
+        previous = signal.getsignal(signal.SIGTERM)
+        threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        start = time.monotonic()
+        call_command(command)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(command.run_times), 1)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous)
+
+    def test_duration_command(self):
+        command = IdleDurationCommand()
+        threading.Timer(0.1, setattr, (command, "need_stop", True)).start()
+        start = time.monotonic()
+        call_command(command)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class TestAdvisoryLock(TestCase):
+
+    def test_key(self):
+        key = AdvisoryLock.get_key("core.management.commands.only_one.Command")
+        self.assertEqual(key, AdvisoryLock.get_key("core.management.commands.only_one.Command"))
+        self.assertNotEqual(key, AdvisoryLock.get_key("core.management.commands.only_two.Command"))
+        self.assertTrue(-2 ** 63 <= key < 2 ** 63)
+
+    def test_not_postgresql(self):
+        with self.assertRaises(NotSupportedError):
+            AdvisoryLock("test").acquire()
+
+
+class TestPruneCommandLogs(TestCase):
+
+    @override_settings(
+            DJANGO_COMMANDS_LOG_RETENTION=datetime.timedelta(days=10),
+            DJANGO_COMMANDS_LOG_RETENTION_BY_NAME={"fast": datetime.timedelta(days=1)})
+    def test_prune(self):
+        now = timezone.now()
+        for name, days in [("fast", 0), ("fast", 2), ("fast", 2), ("slow", 2), ("slow", 20)]:
+            log = CommandLog.objects.create(name=name, status="finished")
+            CommandLog.objects.filter(pk=log.pk).update(
+                    create_datetime=now - datetime.timedelta(days=days, seconds=10),
+                    update_datetime=now - datetime.timedelta(days=days))
+        call_command("prune_command_logs", "--batch-size", "1")
+        self.assertEqual(
+                sorted(CommandLog.objects.values_list("name", flat=True)), ["fast", "slow"])
+        rollup = CommandLogRollup.objects.get(name="fast")
+        self.assertEqual(rollup.count, 2)
+        self.assertAlmostEqual(rollup.total_duration, 20)
+        self.assertAlmostEqual(rollup.max_duration, 10)
+        self.assertEqual(CommandLogRollup.objects.get(name="slow").count, 1)
+
+
+class StatsCommand(MultiTimesCommand):
+    INTERVAL = 0
+    MAX_TIMES = 3
+    RECORD_STATS = True
+
+    def handle(self, *args, **kwargs):
+        list(CommandLog.objects.filter(name="nothing"))
+        return self.run_cnt
+
+
+class FailedUniqueCommand(UniqueCommand):
+    RECORD_STATS = True
+
+    def handle(self):
+        CommandLog.objects.count()
+        raise ValueError("failed")
+
+
+class TestRunStats(TestCase):
+
+    def test_loop(self):
+        call_command(StatsCommand())
+        logs = CommandLog.objects.filter(name=f"{__name__}.StatsCommand").order_by("pk")
+        self.assertEqual([log.rows for log in logs], [1, 2, 3])
+        self.assertEqual({log.query_count for log in logs}, {1})
+        self.assertEqual({log.status for log in logs}, {"finished"})
+        self.assertTrue(all(log.duration >= 0 and log.max_rss > 0 for log in logs))
+        percentiles = CommandLog.objects.get_duration_percentiles()
+        self.assertEqual(percentiles[f"{__name__}.StatsCommand"]["count"], 3)
+
+    def test_failed(self):
+        with self.assertRaises(ValueError):
+            call_command(FailedUniqueCommand())
+        log = CommandLog.objects.get(name=f"{__name__}.FailedUniqueCommand")
+        self.assertEqual(log.status, "failed")
+        self.assertEqual(log.query_count, 1)
+
+
+class AdvisoryUniqueCommand(UniqueCommand):
+    LOCK_BACKEND = "advisory"
+    LOCK_DATABASE = "default"
+    AUDIT_LOG = True
+    runs = 0
+
+    def handle(self):
+        self.runs += 1
+        CommandLog.objects.count()
+
+
+class TestUniqueCommandLock(TransactionTestCase):
+    """
+    the audit logs are written in other threads, so the test can not run in a transaction
+    """
+
+    def call(self, command, acquired=True, **kwargs):
+        with mock.patch("django_commands.commands.AdvisoryLock") as lock_class:
+            lock_class.return_value.acquire.return_value = acquired
+            call_command(command, **kwargs)
+        lock_class.assert_called_once_with(f"{__name__}.AdvisoryUniqueCommand", using="default")
+        if command._audit_thread:  # pylint: disable=protected-access
+            command._audit_thread.join()  # pylint: disable=protected-access
+        return lock_class.return_value
+
+    def test_advisory_lock(self):
+        command = AdvisoryUniqueCommand()
+        lock = self.call(command)
+        self.assertEqual(command.runs, 1)
+        lock.release.assert_called_once_with()
+        log = CommandLog.objects.get(name=f"{__name__}.AdvisoryUniqueCommand")
+        self.assertEqual((log.status, log.duration), ("finished", None))
+        command = AdvisoryUniqueCommand()
+        lock = self.call(command, acquired=False)
+        self.assertEqual(command.runs, 0)
+        lock.release.assert_not_called()
+        self.assertEqual(CommandLog.objects.filter(status="skipped").count(), 1)
+
+    def test_audit_log_with_stats(self):
+        command = AdvisoryUniqueCommand()
+        command.RECORD_STATS = True
+        bulk_create = CommandLog.objects.bulk_create
+        threads = []
+
+        def record_thread(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(CommandLog.objects, "bulk_create", side_effect=record_thread):
+            self.call(command)
+        # only one CommandLog of the run, written in the audit thread
+        self.assertEqual(threads, [f"{__name__}.AdvisoryUniqueCommand:audit"])
+        log = CommandLog.objects.get(name=f"{__name__}.AdvisoryUniqueCommand")
+        self.assertEqual((log.status, log.query_count), ("finished", 1))
+        self.assertGreaterEqual(log.duration, 0)
+
+    def test_stats_without_audit_log(self):
+        command = AdvisoryUniqueCommand()
+        command.RECORD_STATS, command.AUDIT_LOG = True, False
+        self.call(command)
+        self.assertIsNone(command._audit_thread)  # pylint: disable=protected-access
+        log = CommandLog.objects.get(name=f"{__name__}.AdvisoryUniqueCommand")
+        self.assertEqual((log.status, log.query_count), ("finished", 1))
+
+
+class TestCommandJob(TransactionTestCase):
+    """
+    the jobs run in other threads, so the test can not run in a transaction
+    """
+
+    @override_settings(DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"])
+    def test_job(self):
+        client = APIClient()
+        res = client.post("/api/django-commands/call-command/", {
+            "command": "test_datetime_option", "using": "thread", "args": ["2024-01-02"],
+        }, format="json")
+        job_id = res.json()["job_id"]
+        res = client.get(f"/api/django-commands/jobs/{job_id}/", {"wait": 5})
+        self.assertEqual(res.json()["status"], "finished")
+        self.assertIn("datetime(2024, 1, 2", res.json()["output"])
+        res = client.get(f"/api/django-commands/jobs/{job_id}/stream/", {"offset": 1}, HTTP_ACCEPT="text/event-stream")
+        content = b"".join(res.streaming_content).decode()
+        self.assertIn("event: output\ndata: datetime.datetime(2024, 1, 2", content)
+        self.assertTrue(content.endswith('event: end\ndata: {"status": "finished"}\n\n'))
+        res = client.get("/api/django-commands/jobs/nothing/stream/", HTTP_ACCEPT="text/event-stream")
+        self.assertEqual(res.status_code, 404)
+
+    def test_job_output_while_running(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_call_command(command, *args, stdout=None, stderr=None, **kwargs):
+            stdout.write("begin\n")
+            started.set()
+            release.wait(5)
+            stdout.write("end\n")
+
+        executor = CommandExecutor(max_workers=1)
+        with mock.patch("django_commands.jobs.call_command", side_effect=slow_call_command), \
+                mock.patch.object(views.CommandJobStreamView, "MAX_DURATION", 2), \
+                mock.patch.object(views.CommandJobStreamView, "POLL_INTERVAL", 0.1):
+            job_id = executor.submit("slow_command")
+            try:
+                self.assertTrue(started.wait(5))
+                res = APIClient().get(f"/api/django-commands/jobs/{job_id}/stream/", HTTP_ACCEPT="text/event-stream")
+                content = b"".join(res.streaming_content).decode()
+                self.assertEqual(CommandJob.objects.get(job_id=job_id).status, "running")
+            finally:
+                release.set()
+                executor.executor.shutdown()
+        self.assertEqual(content, "id: 6\nevent: output\ndata: begin\ndata: \n\n")
+        job = CommandJob.objects.get(job_id=job_id)
+        self.assertEqual((job.status, job.output), ("finished", "begin\nend\n"))
+
+    def test_job_bad_params(self):
+        client = APIClient()
+        job = CommandJob.objects.create(command="test_datetime_option", status="running")
+        res = client.get(f"/api/django-commands/jobs/{job.job_id}/", {"wait": "soon"})
+        self.assertEqual(res.status_code, 400)
+        res = client.get(f"/api/django-commands/jobs/{job.job_id}/stream/", {"offset": "-1"})
+        self.assertEqual(res.status_code, 400)
+        res = client.get(
+                f"/api/django-commands/jobs/{job.job_id}/stream/",
+                HTTP_ACCEPT="text/event-stream", HTTP_LAST_EVENT_ID="abc")
+        self.assertEqual(res.status_code, 400)
+        with mock.patch.object(views.CommandJobStreamView, "MAX_DURATION", 0):
+            res = client.get(f"/api/django-commands/jobs/{job.job_id}/stream/", HTTP_ACCEPT="text/event-stream")
+            self.assertEqual(b"".join(res.streaming_content), b"")
+
+    def test_job_queue_full(self):
+        executor = CommandExecutor(max_workers=1, max_jobs=2, command_concurrency={"slow_command": 1})
+        executor.submit("slow_command")
+        with self.assertRaises(JobQueueFull):
+            executor.submit("slow_command")
+        executor.submit("test_datetime_option", ["2024-01-01"])
+        with self.assertRaises(JobQueueFull):
+            executor.submit("test_datetime_option", ["2024-01-01"])
+
+    @override_settings(DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"])
+    def test_batch(self):
+        client = APIClient()
+        executor = CommandExecutor(max_workers=2)
+        data = {"command": "test_datetime_option", "args": ["2024-01-02"]}
+        with mock.patch("django_commands.jobs.get_executor", return_value=executor):
+            res = client.post("/api/django-commands/call-commands/", {"calls": [
+                data, data, {**data, "args": ["2024-01-03"]}, {**data, "idempotency_key": "batch-1"},
+            ]}, format="json")
+            executor.executor.shutdown()
+        self.assertEqual(res.status_code, 200)
+        first, second, third, fourth = res.json()["results"]
+        self.assertEqual(second, {"job_id": first["job_id"], "coalesced": True})
+        self.assertEqual(third["coalesced"], False)
+        self.assertEqual(fourth, {"job_id": first["job_id"], "coalesced": True})
+        self.assertEqual(CommandJob.objects.count(), 2)
+        self.assertEqual(CommandJob.objects.filter(status="finished", using="thread").count(), 2)
+        res = client.post("/api/django-commands/call-commands/", {"calls": [
+            data, {"command": "non_exist_command"},
+        ]}, format="json")
+        self.assertEqual(res.status_code, 403)
+        # the local calls would block the request one by one
+        res = client.post("/api/django-commands/call-commands/", {"calls": [{**data, "using": "local"}]}, format="json")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(CommandJob.objects.count(), 2)
+        res = client.post("/api/django-commands/call-commands/", [data], format="json")
+        self.assertEqual(res.status_code, 400)
+
+
+class TestRegistry(TestCase):
+
+    def test_registry(self):
+        self.assertIn("slow_command", registry.entries)
+        command_registry = CommandRegistry()
+        command_registry.build(["test_datetime_option", "non_exist_command"])
+        self.assertEqual(list(command_registry.entries), ["test_datetime_option"])
+        output = io.StringIO()
+        command_registry.call_command("test_datetime_option", "2024-01-02", ["2024-01-03"], stdout=output)
+        self.assertIn("datetime(2024, 1, 3", output.getvalue())
+        with self.assertRaises(TypeError):
+            command_registry.call_command("test_datetime_option", "2024-01-02", unknown=1)
+        output = io.StringIO()
+        command_registry.call_command("check", stdout=output)
+        self.assertIn("no issues", output.getvalue())
+        # the cached parser is used
+        entry = command_registry.entries["test_datetime_option"]
+        with mock.patch.object(entry.command_class, "create_parser") as create_parser:
+            command_registry.call_command("test_datetime_option", "2024-01-02", stdout=io.StringIO())
+        create_parser.assert_not_called()
+
+    def test_setting_changed(self):
+        with override_settings(DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"]):
+            self.assertEqual(list(registry.entries), ["test_datetime_option"])
+        self.assertIn("slow_command", registry.entries)
+
+
 class TestAsyncCommand(TestCase):
 
     def test_async(self):
@@ -39,7 +579,7 @@ class TestAsyncCommand(TestCase):
         res = client.post("/api/django-commands/call-command/",
                           {"command": "slow_command", "using": "thread"}, format="json")
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(res.json(), {})
+        self.assertEqual(len(res.json()["job_id"]), 32)
 
         self.assertGreater(
                 start + 1,
@@ -47,21 +587,113 @@ class TestAsyncCommand(TestCase):
         )
 
         res = client.post("/api/django-commands/call-command/",
-                          {"command": "slow_command"}, format="json")
+                          {"command": "slow_command", "coalesce": False}, format="json")
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(res.json(), {})
+        job = CommandJob.objects.get(job_id=res.json()["job_id"])
+        self.assertEqual(job.status, "finished")
+        self.assertIn("run slow_command: end", job.output)
 
         self.assertGreater(
                 start + 6,
                 time.time(),
         )
 
+    @override_settings(DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"])
+    def test_coalesce(self):
+        client = APIClient()
+        data = {"command": "test_datetime_option", "args": ["2024-01-02"]}
+        running = CommandJob.objects.create(
+                command="test_datetime_option", args=["2024-01-02"], status="running",
+                coalesce_key=get_coalesce_key("test_datetime_option", ["2024-01-02"], {}))
+        res = client.post("/api/django-commands/call-command/", {**data, "using": "thread"}, format="json")
+        self.assertEqual(res.json(), {"job_id": running.job_id, "coalesced": True})
+        res = client.post("/api/django-commands/call-command/", {**data, "coalesce": False}, format="json")
+        self.assertEqual(res.json()["coalesced"], False)
+        self.assertNotEqual(res.json()["job_id"], running.job_id)
+
+    @override_settings(DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"])
+    def test_idempotency_key(self):
+        client = APIClient()
+        data = {"command": "test_datetime_option", "args": ["2024-01-02"], "idempotency_key": "deploy-1"}
+        job_id = client.post("/api/django-commands/call-command/", data, format="json").json()["job_id"]
+        res = client.post("/api/django-commands/call-command/", data, format="json")
+        self.assertEqual(res.json(), {"job_id": job_id, "coalesced": True})
+        res = client.post("/api/django-commands/call-command/", data, format="json", HTTP_IDEMPOTENCY_KEY="deploy-2")
+        self.assertEqual(res.json(), {"job_id": job_id, "coalesced": True})
+        self.assertEqual(CommandJob.objects.get(job_id=job_id).status, "finished")
+
+    @override_settings(
+            DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"], DJANGO_COMMANDS_JOB_WAIT_TIMEOUT=0.1)
+    def test_stale_job(self):
+        client = APIClient()
+        data = {"command": "test_datetime_option", "args": ["2024-01-02"]}
+        coalesce_key = get_coalesce_key("test_datetime_option", ["2024-01-02"], {})
+        running = CommandJob.objects.create(
+                command="test_datetime_option", args=["2024-01-02"], status="running", coalesce_key=coalesce_key)
+        start = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            res = client.post("/api/django-commands/call-command/", data, format="json")
+        self.assertEqual(res.json(), {"job_id": running.job_id, "coalesced": True})
+        self.assertLess(time.time() - start, 1)
+        # the jobs are expired only if the found job is stale
+        self.assertFalse([query for query in queries if query["sql"].startswith("UPDATE")])
+        CommandJob.objects.filter(pk=running.pk).update(
+                heartbeat_datetime=timezone.now() - datetime.timedelta(hours=1))
+        res = client.post("/api/django-commands/call-command/", data, format="json")
+        self.assertEqual(res.json()["coalesced"], False)
+        running.refresh_from_db()
+        self.assertEqual(running.status, "failed")
+        self.assertEqual(CommandJob.objects.get(job_id=res.json()["job_id"]).status, "finished")
+        # the batch calls expire the stale jobs too
+        running = CommandJob.objects.create(
+                command="test_datetime_option", args=["2024-01-02"], status="running", coalesce_key=coalesce_key,
+                heartbeat_datetime=timezone.now() - datetime.timedelta(hours=1))
+        res = client.post("/api/django-commands/call-commands/", {"calls": [data]}, format="json")
+        self.assertEqual(res.json()["results"][0]["coalesced"], False)
+        running.refresh_from_db()
+        self.assertEqual(running.status, "failed")
+
+    @override_settings(DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"])
+    def test_idempotency_key_conflict(self):
+        client = APIClient()
+        data = {"command": "test_datetime_option", "args": ["2024-01-02"], "idempotency_key": "deploy-3"}
+        client.post("/api/django-commands/call-command/", data, format="json")
+        res = client.post("/api/django-commands/call-command/", {**data, "args": ["2024-01-03"]}, format="json")
+        self.assertEqual(res.status_code, 409)
+
     def test_deny_command(self):
         client = APIClient()
         res = client.post("/api/django-commands/call-command/",
                           {"command": "non_exist_command"}, format="json")
         self.assertEqual(res.status_code, 403)
 
+    @override_settings(
+            DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"],
+            DJANGO_COMMANDS_PERMISSION_CLASSES=["rest_framework.permissions.IsAdminUser"])
+    def test_permission_classes(self):
+        client = APIClient()
+        job = CommandJob.objects.create(command="test_datetime_option", status="finished")
+        data = {"command": "test_datetime_option", "args": ["2024-01-02"]}
+        res = client.post("/api/django-commands/call-command/", data, format="json")
+        self.assertEqual(res.status_code, 403)
+        res = client.post("/api/django-commands/call-commands/", {"calls": [data]}, format="json")
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(client.get(f"/api/django-commands/jobs/{job.job_id}/").status_code, 403)
+        client.force_authenticate(User.objects.create(username="admin", is_staff=True))
+        res = client.post("/api/django-commands/call-command/", data, format="json")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(client.get(f"/api/django-commands/jobs/{job.job_id}/").status_code, 200)
+
+    @override_settings(DJANGO_COMMANDS_ALLOW_REMOTE_CALL=["test_datetime_option"])
+    def test_batch_release_executor(self):
+        executor = CommandExecutor(max_workers=1, max_jobs=2)
+        data = {"command": "test_datetime_option", "using": "thread", "args": ["2024-01-02"]}
+        with mock.patch("django_commands.jobs.get_executor", return_value=executor), \
+                mock.patch.object(CommandJob.objects, "bulk_create", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                APIClient().post("/api/django-commands/call-commands/", {"calls": [data]}, format="json")
+        self.assertEqual(executor.jobs, 0)
+
 
 class TestUtil(TestCase):
 
@@ -83,6 +715,22 @@ class TestUtil(TestCase):
             results.extend([command.name for command in queryset])
         self.assertEqual(len(queryset), 100)
 
+    def test_task_statistics(self):
+        with mock.patch("time.monotonic", return_value=100):
+            statistics = TaskStatistics()
+        for i in range(5000):
+            statistics.add(i % 2, i / 1000, rows=2)
+        self.assertEqual(len(statistics.latency.samples), TaskStatistics.RESERVOIR_SIZE)
+        with mock.patch("time.monotonic", return_value=110):
+            statistics.finish()
+        with mock.patch("time.monotonic", return_value=200):
+            summary = statistics.summary()
+        self.assertEqual(summary["elapsed"], 10)
+        self.assertEqual(summary["tasks_per_second"], 500)
+        self.assertEqual(summary["rows_per_second"], 1000)
+        self.assertEqual(summary["workers"][0]["tasks"], 2500)
+        self.assertLess(abs(summary["p50"] - 2.5), 0.5)
+
     def test_bisect(self):
         self.assertAlmostEqual(
             BisectTask(0, 9, 1).find_first_error(),
@@ -110,3 +758,72 @@ class TestUtil(TestCase):
         a, b = iter_large_queryset(CommandLog.objects.all(), batch_size=2, ordering_field="name")
         self.assertEqual(
             b.get().name, "ccc")
+
+    def test_iter_keyset_boundaries(self):
+        for i in range(25):
+            CommandLog.objects.create(name=str(i % 3))
+        boundaries = list(iter_keyset_boundaries(CommandLog.objects.all(), batch_size=10))
+        self.assertEqual(len(boundaries), 3)
+        self.assertEqual(
+            sum(CommandLog.objects.filter(keyset_range_q(["pk"], start, end)).count()
+                for start, end in boundaries),
+            25)
+
+        boundaries = list(iter_keyset_boundaries(
+            CommandLog.objects.all(), batch_size=4, ordering_fields=["-name"]))
+        names = []
+        for start, end in boundaries:
+            queryset = CommandLog.objects.filter(keyset_range_q(["-name"], start, end))
+            self.assertLessEqual(queryset.count(), 4)
+            names.extend(queryset.order_by("-name", "pk").values_list("name", flat=True))
+        self.assertEqual(names, sorted(CommandLog.objects.values_list("name", flat=True), reverse=True))
+
+    def test_iter_keyset_chunks(self):
+        for i in range(25):
+            CommandLog.objects.create(name=str(i % 3))
+        chunks = list(iter_keyset_chunks(CommandLog.objects.all(), batch_size=10, ordering_fields=["name"]))
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual(len({obj.pk for chunk in chunks for obj in chunk}), 25)
+
+    def test_iter_pk_ranges(self):
+        self.assertEqual(list(iter_pk_ranges(CommandLog.objects.all(), 10)), [])
+        objs = [CommandLog.objects.create(name=str(i)) for i in range(25)]
+        CommandLog.objects.filter(pk__lt=objs[20].pk, pk__gt=objs[3].pk).delete()
+        queryset = CommandLog.objects.all()
+        ranges = list(iter_pk_ranges(queryset, 10))
+        self.assertEqual(ranges[0][0], objs[0].pk)
+        self.assertEqual(ranges[-1][1], objs[-1].pk)
+        self.assertEqual(list(iter_histogram_ranges(queryset, 10)), ranges)
+        balanced = list(iter_balanced_ranges(queryset, ranges, max_count=2))
+        counts = [queryset.filter(pk__gte=start, pk__lte=end).count() for start, end in balanced]
+        self.assertTrue(all(0 < count <= 2 for count in counts))
+        self.assertEqual(sum(counts), 9)
+
+    def test_split_histogram(self):
+        # 4 buckets of 1000 rows are cut into 4 pieces of 250 rows
+        ranges = list(split_histogram([0, 100, 200, 300, 400], 4000, 250))
+        self.assertEqual(len(ranges), 16)
+        self.assertEqual(ranges[:4], [(0, 24), (25, 49), (50, 74), (75, 99)])
+        self.assertEqual(ranges[-1], (375, 400))
+        # 10 buckets of 10 rows are merged 5 by 5
+        bounds = [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+        self.assertEqual(list(split_histogram(bounds, 100, 50)), [(0, 15), (16, 512)])
+        # the last merged range covers the remaining buckets
+        self.assertEqual(list(split_histogram(bounds, 100, 40)), [(0, 7), (8, 127), (128, 512)])
+        self.assertEqual(list(split_histogram(bounds, 0, 40)), [(0, 512)])
+        # the ranges never overlap and cover the whole histogram
+        for rows, batch_size in [(1, 1000), (100, 7), (100000, 33), (5000, 1000)]:
+            ranges = list(split_histogram(bounds, rows, batch_size))
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], 512)
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end + 1, start)
+
+    def test_iter_histogram_ranges(self):
+        objs = [CommandLog.objects.create(name=str(i)) for i in range(10)]
+        queryset = CommandLog.objects.all()
+        # the outdated statistics are extended to the current min and max
+        statistics = ([objs[2].pk, objs[5].pk, objs[7].pk], 10)
+        with mock.patch("django_commands.utils.get_histogram_statistics", return_value=statistics):
+            ranges = list(iter_histogram_ranges(queryset, 5))
+        self.assertEqual(ranges, [(objs[0].pk, objs[4].pk), (objs[5].pk, objs[-1].pk)])
@@ -3,13 +3,21 @@
 # Xiang Wang <ramwin@qq.com>
 
 
+import asyncio
 import logging
 import random
 import time
 
-from threading import Thread
-from django.test import TestCase
+from threading import Event, Lock, Thread, get_ident
+from unittest import mock
+
+import fakeredis
+from fakeredis import aioredis
+from redis.asyncio import client as aioredis_client
+from django.test import TestCase, override_settings
 from django.core.management import call_command
+from django_commands.commands import UniqueCommand, WaitCommand
+from django_commands.queues import ListQueue, ReliableListQueue, StreamQueue, get_async_redis_connection
 from django_commands.management.commands.test_wait_commands import Command as TestWaitCommand
 
 
@@ -20,6 +28,281 @@ LOGGER.addHandler(handler)
 LOGGER.setLevel(logging.DEBUG)
 
 
+class RedisUniqueCommand(UniqueCommand):
+    LOCK_BACKEND = "redis"
+    LOCK_TIMEOUT = 0.3
+    runs = []
+
+    def handle(self):
+        self.runs.append(self.lock.fencing_token)
+        time.sleep(0.5)
+        assert not self.lock.lost
+
+
+class ConcurrentWaitCommand(WaitCommand):
+    SQUASH_TASK = False
+    BATCH_SIZE = 2
+    BLOCK_TIMEOUT = 0.1
+    CONCURRENCY = 4
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handled = []
+        self.threads = set()
+        self.lock = Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def handle_task(self, task_id, *args, **kwargs):
+        if task_id == b"error":
+            raise ValueError("error task")
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        self.handled.append(task_id)
+        self.threads.add(get_ident())
+
+
+class SquashWaitCommand(WaitCommand):
+    SQUASH_TASK = True
+
+
+class DelayedWaitCommand(WaitCommand):
+    SQUASH_TASK = False
+    DEDUPLICATE = True
+    DELAYED_TASK = True
+
+
+class FakeRedisTestCase(TestCase):
+    """
+    get_redis_connection and get_async_redis_connection return fakeredis clients of the same server
+    """
+
+    def setUp(self):
+        super().setUp()
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server)
+        for patcher in [
+            mock.patch("django_commands.commands.get_redis_connection", return_value=self.redis),
+            mock.patch(
+                "django_commands.commands.get_async_redis_connection",
+                side_effect=lambda alias="default": aioredis.FakeRedis(server=server)),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestFakeRedis(FakeRedisTestCase):
+
+    @staticmethod
+    def wait_tasks(queue):
+        """
+        pop returns [] when it's woken up or the next delayed task is due
+        """
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            tasks = queue.pop(10, 5)
+            if tasks:
+                return tasks
+        return []
+
+    def test_concurrent_wait_command(self):
+        ConcurrentWaitCommand.create_tasks([str(i) for i in range(20)])
+        command = ConcurrentWaitCommand()
+        with mock.patch("django_commands.commands.connections.close_all") as close_all:
+            call_command(command, times=20)
+        self.assertEqual(sorted(command.handled), sorted(str(i).encode() for i in range(20)))
+        self.assertGreater(len(command.threads), 1)
+        self.assertGreater(command.max_running, 1)
+        self.assertLessEqual(command.max_running, ConcurrentWaitCommand.CONCURRENCY)
+        # every worker thread closes its connections
+        self.assertEqual(close_all.call_count, ConcurrentWaitCommand.CONCURRENCY)
+        self.assertEqual(ConcurrentWaitCommand.get_queue().info()["length"], 0)
+
+    def test_concurrent_wait_command_error(self):
+        ConcurrentWaitCommand.create_tasks(["1", "2", "error", "3", "4", "5"])
+        command = ConcurrentWaitCommand()
+        command.BATCH_SIZE = 1
+        with self.assertRaises(ValueError):
+            call_command(command, times=6)
+        self.assertIn(b"1", command.handled)
+        self.assertNotIn(b"error", command.handled)
+
+    def test_create_tasks(self):
+        self.assertEqual(SquashWaitCommand.create_tasks(["1", "2", "1", "3"], chunk_size=2), 3)
+        self.assertEqual(self.redis.lrange(SquashWaitCommand.get_queue().key, 0, -1), [b"1", b"2", b"3"])
+        self.assertEqual(TestWaitCommand.create_tasks(["1", "1"]), 2)
+        self.assertEqual(TestWaitCommand.get_backlog(), {"length": 2, "delayed": 0})
+        self.assertEqual(SquashWaitCommand.create_tasks([]), 0)
+
+    def test_acreate_tasks(self):
+        async def create():
+            await SquashWaitCommand.acreate_task("0")
+            return await SquashWaitCommand.acreate_tasks(["1", "2", "1"], chunk_size=1)
+
+        self.assertEqual(asyncio.run(create()), 2)
+        self.assertEqual(self.redis.lrange(SquashWaitCommand.get_queue().key, 0, -1), [b"0", b"1", b"2"])
+
+    def test_acreate_delayed_tasks(self):
+        async def create():
+            await DelayedWaitCommand.acreate_tasks(["1", "2"])
+            await DelayedWaitCommand.acreate_tasks(["2", "3"], delay=60)
+
+        asyncio.run(create())
+        self.assertEqual(DelayedWaitCommand.get_backlog(), {"length": 2, "delayed": 2})
+        self.assertEqual([task.task_id for task in DelayedWaitCommand.get_queue().pop(10, 0.1)], [b"1", b"2"])
+
+    def test_deduplicate(self):
+        queue = ListQueue(self.redis, "test_deduplicate", deduplicate=True)
+        queue.push(["1", "2", "1"])
+        queue.push(["2", "3"])
+        self.assertEqual([task.task_id for task in queue.pop(10, 0.1)], [b"1", b"2", b"3"])
+        queue.push(["1"])
+        self.assertEqual([task.task_id for task in queue.pop(10, 0.1)], [b"1"])
+
+    def test_delayed_task(self):
+        # the TIME of the fake redis server
+        server_time = mock.Mock()
+        server_time.time.return_value = 1000.0
+        queue = ListQueue(self.redis, "test_delayed", delayed=True, deduplicate=True)
+        blocks = []
+        blocking = Event()
+
+        def block(timeout):
+            blocking.set()
+            task_id = ListQueue._block(queue, timeout)  # pylint: disable=protected-access
+            blocks.append((timeout, task_id))
+            return task_id
+
+        with mock.patch("fakeredis.commands_mixins.server_mixin.time", server_time), \
+                mock.patch.object(queue, "_block", side_effect=block):
+            queue.push(["late"], run_at=1000.5)
+            queue.push(["now"])
+            self.assertEqual([task.task_id for task in queue.pop(10, 0.1)], [b"now"])
+            self.assertEqual(queue.info(), {"length": 0, "delayed": 1})
+            # the consumer blocks until the late task is due, and is woken up by an earlier delayed task
+            popped = []
+            consumer = Thread(target=lambda: popped.append(queue.pop(10, 5)))
+            consumer.start()
+            blocking.wait(5)
+            queue.push(["early"], run_at=1000.2)
+            consumer.join()
+            self.assertEqual((popped, blocks), ([[]], [(0.5, ListQueue.WAKE_UP)]))
+            blocks.clear()
+            self.assertEqual(queue.pop(10, 5), [])
+            self.assertEqual(len(blocks), 1)
+            self.assertAlmostEqual(blocks[0][0], 0.2)
+            server_time.time.return_value = 1000.2
+            self.assertEqual([task.task_id for task in queue.pop(10, 5)], [b"early"])
+            server_time.time.return_value = 1000.5
+            self.assertEqual([task.task_id for task in queue.pop(10, 5)], [b"late"])
+
+    def test_reliable_delayed_task(self):
+        queue = ReliableListQueue(self.redis, "test_reliable_delayed", delayed=True)
+        Thread(target=queue.push, args=(["early"],), kwargs={"run_at": time.time() + 0.2}).start()
+        tasks = self.wait_tasks(queue)
+        self.assertEqual([task.task_id for task in tasks], [b"early"])
+        queue.ack(tasks)
+        self.assertEqual(self.redis.llen(queue.processing_key), 0)
+
+    def test_recover(self):
+        dead = ReliableListQueue(self.redis, "test_recover", deduplicate=True, consumer_timeout=60)
+        dead.push(["1", "2"])
+        self.assertEqual([task.task_id for task in dead.pop(10, 0.1)], [b"1", b"2"])
+        dead.push(["1"])
+        self.redis.zadd(dead.consumers_key, {dead.consumer: 0})
+        alive = ReliableListQueue(self.redis, "test_recover", deduplicate=True, consumer_timeout=60)
+        alive.heartbeat()
+        # 1 is waiting in the queue already
+        self.assertEqual(alive.recover(), 1)
+        self.assertEqual(self.redis.lrange(alive.key, 0, -1), [b"2", b"1"])
+        self.assertEqual(self.redis.smembers(alive.queued_key), {b"1", b"2"})
+        self.assertEqual(self.redis.llen(dead.processing_key), 0)
+        self.assertEqual(self.redis.zrange(alive.consumers_key, 0, -1), [alive.consumer.encode()])
+        self.assertEqual(alive.recover(), 0)
+
+    def test_stream_clear(self):
+        queue = StreamQueue(self.redis, "test_stream")
+        queue.start()
+        queue.push(["1", "2"])
+        queue.clear()
+        self.assertEqual(queue.info()["length"], 0)
+        queue.push(["3"])
+        self.assertEqual([task.task_id for task in queue.pop(10, 0.1)], [b"3"])
+
+    def test_stream_squash(self):
+        other = StreamQueue(self.redis, "test_stream_squash")
+        other.start()
+        queue = StreamQueue(self.redis, "test_stream_squash", squash=True)
+        queue.push(["1", "2", "3"])
+        self.assertEqual([task.task_id for task in other.pop(1, 0.1)], [b"1"])
+        self.assertEqual([task.task_id for task in queue.pop(1, 0.1)], [b"2"])
+        # 3 is squashed into 2, the pending 1 of the other consumer is kept
+        self.assertEqual(queue.info(), {"length": 3, "pending": 2, "lag": 0})
+        self.assertEqual(queue.pop(1, 0.1), [])
+
+    def test_shared_queue(self):
+        SquashWaitCommand.create_task("1")
+        queue = SquashWaitCommand._get_shared_queue()  # pylint: disable=protected-access
+        SquashWaitCommand.clear_task()
+        self.assertIs(SquashWaitCommand._get_shared_queue(), queue)  # pylint: disable=protected-access
+        self.assertIsNot(SquashWaitCommand.get_queue(), queue)
+
+    def test_redis_lock(self):
+        RedisUniqueCommand.runs = []
+        errors = []
+
+        def run():
+            try:
+                call_command(RedisUniqueCommand())
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                errors.append(error)
+
+        threads = [Thread(target=run) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        self.assertEqual(len(RedisUniqueCommand.runs), 1)
+        call_command(RedisUniqueCommand())
+        self.assertEqual(RedisUniqueCommand.runs[1], RedisUniqueCommand.runs[0] + 1)
+
+
+class TestAsyncRedisConnection(TestCase):
+
+    @override_settings(CACHES={"default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "rediss://redis.example.com:6380/2,rediss://replica.example.com:6380/2",
+        "OPTIONS": {
+            "PASSWORD": "secret",
+            "SOCKET_TIMEOUT": 3,
+            "CONNECTION_POOL_KWARGS": {"max_connections": 10, "ssl_cert_reqs": None},
+        },
+    }})
+    def test_options(self):
+        async def get_clients():
+            client = get_async_redis_connection()
+            self.assertIs(get_async_redis_connection(), client)
+            await asyncio.sleep(0)
+            return client
+
+        with mock.patch.object(aioredis_client.Redis, "aclose", autospec=True) as aclose:
+            client = asyncio.run(get_clients())
+        kwargs = client.connection_pool.connection_kwargs
+        self.assertEqual(
+            (kwargs["host"], kwargs["port"], kwargs["db"], kwargs["password"], kwargs["socket_timeout"]),
+            ("redis.example.com", 6380, 2, "secret", 3))
+        self.assertIsNone(kwargs["ssl_cert_reqs"])
+        self.assertEqual(client.connection_pool.max_connections, 10)
+        # closed when asyncio.run shuts down the loop
+        aclose.assert_called_once_with(client, close_connection_pool=True)
+
+
 class Test(TestCase):
 
     def test_wait_command(self):
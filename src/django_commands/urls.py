@@ -10,4 +10,7 @@ from . import views
 
 urlpatterns = [
         path("call-command/", views.CallCommandView.as_view()),
+        path("call-commands/", views.BatchCallCommandView.as_view()),
+        path("jobs/<str:job_id>/", views.CommandJobView.as_view()),
+        path("jobs/<str:job_id>/stream/", views.CommandJobStreamView.as_view()),
 ]
@@ -11,14 +11,17 @@ datetime option
 import datetime
 import itertools
 import logging
+import math
+import random
 import re
+import time
 from graphlib import TopologicalSorter
 
-from typing import Iterable, List
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 from django.contrib.admin.utils import NestedObjects
-from django.db import router
-from django.db.models import QuerySet, Q, ForeignKey, Model
+from django.db import connections, router
+from django.db.models import QuerySet, Q, ForeignKey, Max, Min, Model
 from django.utils import timezone
 
 from .exceptions import NoErrorException
@@ -102,6 +105,368 @@ def iter_large_queryset(queryset, batch_size: int = 256, ordering_field: str = "
         queryset = queryset.filter(**{f"{ordering_field}__gte": start_value})
 
 
+def iter_batches(iterable: Iterable, batch_size: int) -> Iterator[List]:
+    """
+    split an iterable into lists with batch_size items, the last list may be shorter
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _normalize_ordering(ordering_fields: Sequence[str]) -> List[str]:
+    """
+    make sure the ordering is unique by appending pk as the tie breaker
+    """
+    fields = list(ordering_fields)
+    if not fields:
+        raise ValueError("ordering_fields should not be empty")
+    if not {"pk", "-pk"} & set(fields):
+        fields.append("pk")
+    return fields
+
+
+def _keyset_q(ordering_fields: Sequence[str], values: Sequence, inclusive: bool, after: bool = True) -> Q:
+    """
+    build the row value comparison `(a, b) > (x, y)` as
+    `a > x OR (a = x AND b > y)`, respecting the `-field` desc ordering
+    """
+    result = Q()
+    equals = Q()
+    last_index = len(ordering_fields) - 1
+    for index, (field, value) in enumerate(zip(ordering_fields, values)):
+        name = field.lstrip("-")
+        forward = after != field.startswith("-")
+        lookup = "gt" if forward else "lt"
+        if index == last_index and inclusive:
+            lookup += "e"
+        result |= equals & Q(**{f"{name}__{lookup}": value})
+        equals &= Q(**{name: value})
+    return result
+
+
+def keyset_range_q(ordering_fields: Sequence[str], start: Sequence, end: Sequence) -> Q:
+    """
+    return the filter to fetch rows between the boundaries (both included)
+    yielded by iter_keyset_boundaries
+    """
+    fields = _normalize_ordering(ordering_fields)
+    return (
+        _keyset_q(fields, start, inclusive=True, after=True)
+        & _keyset_q(fields, end, inclusive=True, after=False)
+    )
+
+
+def _get_ordering_value(obj, field: str):
+    for attr in field.lstrip("-").split("__"):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def iter_keyset_boundaries(
+        queryset, batch_size: int = 256,
+        ordering_fields: Sequence[str] = ("pk",)) -> Iterator[Tuple[tuple, tuple]]:
+    """
+    split queryset in batch_size with keyset (seek) pagination.
+    yield (first_row, last_row) for every batch, the rows are the values of the ordering fields
+    (pk is appended as the tie breaker if it is not in the ordering)
+
+    mechanism:
+    only one `values_list` query like below per batch, no matter how deep the batch is
+
+        SELECT a, pk FROM table WHERE (a, pk) > (last_a, last_pk) ORDER BY a, pk LIMIT batch_size
+
+    use keyset_range_q(ordering_fields, first_row, last_row) to filter the rows of the batch
+    """
+    fields = _normalize_ordering(ordering_fields)
+    names = [field.lstrip("-") for field in fields]
+    queryset = queryset.order_by(*fields)
+    last_row = None
+    while True:
+        batch = queryset
+        if last_row is not None:
+            batch = queryset.filter(_keyset_q(fields, last_row, inclusive=False))
+        rows = list(batch.values_list(*names)[:batch_size])
+        if not rows:
+            return
+        yield rows[0], rows[-1]
+        if len(rows) < batch_size:
+            return
+        last_row = rows[-1]
+
+
+def iter_keyset_chunks(
+        queryset, batch_size: int = 256,
+        ordering_fields: Sequence[str] = ("pk",)) -> Iterator[List[Model]]:
+    """
+    same as iter_keyset_boundaries, but yield the materialized objects of every batch.
+    only one query per batch.
+    """
+    fields = _normalize_ordering(ordering_fields)
+    queryset = queryset.order_by(*fields)
+    last_row = None
+    while True:
+        batch = queryset
+        if last_row is not None:
+            batch = queryset.filter(_keyset_q(fields, last_row, inclusive=False))
+        objects = list(batch[:batch_size])
+        if not objects:
+            return
+        yield objects
+        if len(objects) < batch_size:
+            return
+        last_row = tuple(_get_ordering_value(objects[-1], field) for field in fields)
+
+
+def iter_pk_ranges(queryset, step: int = 256, field: str = "pk") -> Iterator[Tuple[int, int]]:
+    """
+    split [min(field), max(field)] of an integer field into (start, end) ranges (both included)
+    with the width of step. only one aggregate query is needed.
+    empty ranges may be yielded for sparse tables, see iter_balanced_ranges
+    """
+    result = queryset.aggregate(min_value=Min(field), max_value=Max(field))
+    if result["min_value"] is None:
+        return
+    for start in range(result["min_value"], result["max_value"] + 1, step):
+        yield start, min(start + step - 1, result["max_value"])
+
+
+def get_histogram_statistics(queryset, field: str = "pk") -> Optional[Tuple[List[int], float]]:
+    """
+    read the histogram bounds of an integer column and the estimated rows of the table
+    from the statistics of postgresql (pg_stats, pg_class).
+    return None if the database is not postgresql or the table has not been analyzed
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    meta = queryset.model._meta
+    column = meta.pk.column if field == "pk" else meta.get_field(field).column
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT histogram_bounds::text::bigint[], "
+            "(SELECT reltuples FROM pg_class WHERE oid = %s::regclass) "
+            "FROM pg_stats "
+            "WHERE schemaname = current_schema() AND tablename = %s AND attname = %s",
+            [meta.db_table, meta.db_table, column],
+        )
+        row = cursor.fetchone()
+    if row is None or not row[0] or len(row[0]) < 2:
+        return None
+    bounds, rows = row
+    return list(bounds), max(rows or 0, 0)
+
+
+def iter_histogram_ranges(queryset, batch_size: int = 256, field: str = "pk") -> Iterator[Tuple[int, int]]:
+    """
+    split an integer field into (start, end) ranges with about batch_size rows according to
+    the histogram of the database statistics, so the skewed data is balanced without a scan.
+    fall back to iter_pk_ranges if there is no statistics
+    """
+    statistics = get_histogram_statistics(queryset, field)
+    if statistics is None:
+        LOGGER.info("no histogram for %s.%s, use arithmetic ranges", queryset.model, field)
+        yield from iter_pk_ranges(queryset, batch_size, field)
+        return
+    result = queryset.aggregate(min_value=Min(field), max_value=Max(field))
+    if result["min_value"] is None:
+        return
+    bounds, rows = statistics
+    # the statistics may be outdated, make sure the whole table is covered
+    bounds[0] = min(bounds[0], result["min_value"])
+    bounds[-1] = max(bounds[-1], result["max_value"])
+    yield from split_histogram(bounds, rows, batch_size)
+
+
+def split_histogram(bounds: List[int], rows: float, batch_size: int = 256) -> Iterator[Tuple[int, int]]:
+    """
+    split the histogram bounds (every bucket holds the same number of rows) of an integer column
+    into (start, end) ranges (both included) with about batch_size rows:
+    the large buckets are cut into pieces and the adjacent small buckets are merged
+    """
+    buckets = max(len(bounds) - 1, 1)
+    bucket_rows = rows / buckets
+    if bucket_rows >= batch_size:
+        merge = 1
+    elif bucket_rows > 0:
+        merge = min(int(batch_size // bucket_rows), buckets)
+    else:
+        merge = buckets
+    pieces = max(int(bucket_rows * merge // batch_size), 1)
+    edges = bounds[::merge]
+    if edges[-1] != bounds[-1]:
+        edges.append(bounds[-1])
+    for index, (lower, upper) in enumerate(zip(edges, edges[1:])):
+        end = upper if index == len(edges) - 2 else upper - 1
+        size = end - lower + 1
+        count = min(pieces, size)
+        for piece in range(count):
+            yield lower + size * piece // count, lower + size * (piece + 1) // count - 1
+
+def iter_balanced_ranges(
+        queryset, ranges: Iterable[Tuple[int, int]],
+        max_count: int, field: str = "pk") -> Iterator[Tuple[int, int]]:
+    """
+    bisect the (start, end) ranges whose count is larger than max_count and skip the empty ranges,
+    so every range has at most max_count rows (unless the range can not be split anymore)
+    """
+    for item in ranges:
+        pending = [item]
+        while pending:
+            start, end = pending.pop()
+            count = queryset.filter(**{f"{field}__gte": start, f"{field}__lte": end}).count()
+            if count == 0:
+                continue
+            if count <= max_count or start == end:
+                yield start, end
+                continue
+            middle = (start + end) // 2
+            pending.append((middle + 1, end))
+            pending.append((start, middle))
+
+
+def percentile(values: Sequence[float], percent: float) -> Optional[float]:
+    """
+    return the nearest-rank percentile (0-100) of values, None if values is empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(math.ceil(len(values) * percent / 100) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class LatencyReservoir:
+    """
+    a uniform sample of at most `size` latencies (reservoir sampling), so the percentiles
+    of a long run don't keep every latency in memory
+    """
+
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self.count = 0
+        self.samples: List[float] = []
+
+    def add(self, latency: float) -> None:
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(latency)
+            return
+        index = random.randrange(self.count)
+        if index < self.size:
+            self.samples[index] = latency
+
+    def percentile(self, percent: float) -> Optional[float]:
+        return percentile(self.samples, percent)
+
+
+class TaskStatistics:
+    """
+    collect the latency of every task and report the throughput (tasks/s, rows/s, ETA).
+    the percentiles are estimated from a reservoir of RESERVOIR_SIZE latencies (of all tasks and of every worker)
+    call finish when the run completes, so elapsed and the throughput of the summary stop growing
+    """
+
+    PERCENTS = (50, 95, 99)
+    RESERVOIR_SIZE = 1000
+
+    def __init__(self, total: Optional[int] = None, interval: float = 10):
+        self.total = total
+        self.interval = interval
+        self.tasks = 0
+        self.rows = 0
+        self.latency = LatencyReservoir(self.RESERVOIR_SIZE)
+        self.latencies: Dict[object, LatencyReservoir] = {}
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+        self._reported = self.start
+
+    def add(self, worker, latency: float, rows: int = 0) -> None:
+        self.tasks += 1
+        self.rows += rows
+        self.latency.add(latency)
+        if worker not in self.latencies:
+            self.latencies[worker] = LatencyReservoir(self.RESERVOIR_SIZE)
+        self.latencies[worker].add(latency)
+
+    def finish(self) -> None:
+        if self.end is None:
+            self.end = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end if self.end is not None else time.monotonic()) - self.start
+
+    @property
+    def tasks_per_second(self) -> float:
+        return self.tasks / max(self.elapsed, 1e-9)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / max(self.elapsed, 1e-9)
+
+    @property
+    def eta(self) -> Optional[float]:
+        """seconds left, None if the total is unknown"""
+        if self.total is None or not self.tasks:
+            return None
+        return (self.total - self.tasks) / self.tasks_per_second
+
+    def report(self, force: bool = False) -> None:
+        """
+        log the progress if it's `interval` seconds since the last report
+        """
+        now = time.monotonic()
+        if not force and now - self._reported < self.interval:
+            return
+        self._reported = now
+        LOGGER.info(
+            "progress: %d/%s tasks, %.1f tasks/s, %.1f rows/s, eta: %s",
+            self.tasks, self.total if self.total is not None else "?",
+            self.tasks_per_second, self.rows_per_second,
+            f"{self.eta:.1f}s" if self.eta is not None else "?",
+        )
+
+    def summary(self) -> dict:
+        """
+        the throughput and the latency percentiles (p50, p95, p99) of all the tasks and every worker
+        """
+        return {
+            "tasks": self.tasks,
+            "rows": self.rows,
+            "elapsed": self.elapsed,
+            "tasks_per_second": self.tasks_per_second,
+            "rows_per_second": self.rows_per_second,
+            **self._get_latency(self.latency),
+            "workers": {worker: self._get_latency(latency) for worker, latency in self.latencies.items()},
+        }
+
+    def report_summary(self) -> None:
+        summary = self.summary()
+        LOGGER.info(
+            "finished %d tasks in %.1fs, %.1f tasks/s, %.1f rows/s",
+            summary["tasks"], summary["elapsed"],
+            summary["tasks_per_second"], summary["rows_per_second"],
+        )
+        for worker, latency in summary["workers"].items():
+            LOGGER.info(
+                "worker %s: %d tasks, p50: %.4fs, p95: %.4fs, p99: %.4fs",
+                worker, latency["tasks"], latency["p50"], latency["p95"], latency["p99"],
+            )
+
+    def _get_latency(self, latency: LatencyReservoir) -> dict:
+        return {
+            "tasks": latency.count,
+            **{
+                f"p{percent}": latency.percentile(percent)
+                for percent in self.PERCENTS
+            },
+        }
+
+
 class Bisect:
 
     def __init__(self, start, end, step, auto_check=True):
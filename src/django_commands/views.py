@@ -1,12 +1,42 @@
+import json
+import math
+import time
+
 from django.conf import settings
+from django.db.models.functions import Substr
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.module_loading import import_string
 
 from rest_framework import serializers
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import APIException, PermissionDenied, Throttled, ValidationError
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.response import Response
-from rest_framework.serializers import Serializer
+from rest_framework.serializers import ModelSerializer, Serializer
 from rest_framework.views import APIView
 
-from .tasks import async_call_command
+from .exceptions import IdempotencyKeyConflict, JobQueueFull
+from .jobs import start_job, start_jobs, wait_job
+from .models import CommandJob
+
+
+class Conflict(APIException):
+    status_code = 409
+    default_detail = "conflict"
+    default_code = "conflict"
+
+
+class CommandAPIView(APIView):
+    """
+    the permission classes are the dotted paths of DJANGO_COMMANDS_PERMISSION_CLASSES,
+    default the DEFAULT_PERMISSION_CLASSES of rest_framework
+    """
+
+    def get_permissions(self):
+        permission_classes = getattr(settings, "DJANGO_COMMANDS_PERMISSION_CLASSES", None)
+        if permission_classes is None:
+            return super().get_permissions()
+        return [import_string(permission_class)() for permission_class in permission_classes]
 
 
 class CallCommandSerializer(Serializer):
@@ -16,12 +46,21 @@ class CallCommandSerializer(Serializer):
     command = serializers.CharField()
     args = serializers.ListField(required=False, default=list)
     kwargs = serializers.DictField(required=False, default=dict)
+    idempotency_key = serializers.CharField(required=False, allow_null=True, default=None)
+    coalesce = serializers.BooleanField(required=False, default=True)
 
     class Meta:
-        fields = ["async", "command", "args", "kwargs"]
+        fields = ["async", "command", "args", "kwargs", "idempotency_key", "coalesce"]
+
 
+class CallCommandView(CommandAPIView):
+    """
+    call a command and return {"job_id": "...", "coalesced": false}
 
-class CallCommandView(APIView):
+    the same idempotency_key (or Idempotency-Key header) returns the same job,
+    the identical calls are coalesced into the queued or running job unless coalesce is false.
+    reusing an idempotency_key with another command, args or kwargs returns 409.
+    """
 
     def post(self, request, *args, **kwargs):
         serializer = CallCommandSerializer(data=request.data)
@@ -30,18 +69,147 @@ class CallCommandView(APIView):
         command = data["command"]
         if command not in settings.DJANGO_COMMANDS_ALLOW_REMOTE_CALL:
             raise PermissionDenied(f"you are not allowed to call command `{command}`")
-        if data["using"] == "celery":
-            async_call_command.delay(
-                    data["command"],
-                    data["using"],
-                    data["args"],
-                    data["kwargs"],
+        try:
+            job_id, created = start_job(
+                    command, data["using"], data["args"], data["kwargs"],
+                    idempotency_key=data["idempotency_key"] or request.headers.get("Idempotency-Key"),
+                    coalesce=data["coalesce"],
             )
-        else:
-            async_call_command(
-                    data["command"],
-                    data["using"],
-                    data["args"],
-                    data["kwargs"],
-            )
-        return Response({})
+        except JobQueueFull as error:
+            raise Throttled(detail=str(error)) from error
+        except IdempotencyKeyConflict as error:
+            raise Conflict(detail=str(error)) from error
+        return Response({"job_id": job_id, "coalesced": not created})
+
+
+class BatchCallSerializer(CallCommandSerializer):
+    """
+    a local call would block the request until the command finished, only thread and celery are allowed
+    """
+    using = serializers.ChoiceField(choices=["thread", "celery"], required=False, default="thread")
+
+
+class BatchCallCommandSerializer(Serializer):
+    calls = BatchCallSerializer(many=True, allow_empty=False)
+
+
+class BatchCallCommandView(CommandAPIView):
+    """
+    call many commands in one request, post {"calls": [<the data of call-command>, ...]}
+    and return {"results": [{"job_id": "...", "coalesced": false}, ...]} in the same order.
+
+    the job of a call which can not be queued is {"job_id": null, "error": "..."}.
+    using is "thread" (default) or "celery", a "local" call returns 400.
+    at most DJANGO_COMMANDS_MAX_BATCH_SIZE (default 1000) calls in one request.
+    """
+    DEFAULT_MAX_BATCH_SIZE = 1000
+
+    def post(self, request, *args, **kwargs):
+        max_batch_size = getattr(settings, "DJANGO_COMMANDS_MAX_BATCH_SIZE", self.DEFAULT_MAX_BATCH_SIZE)
+        if not isinstance(request.data, dict) or not isinstance(request.data.get("calls"), list):
+            raise ValidationError({"calls": ["post {\"calls\": [...]}"]})
+        if len(request.data["calls"]) > max_batch_size:
+            raise ValidationError({"calls": [f"at most {max_batch_size} calls in one request"]})
+        serializer = BatchCallCommandSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        calls = serializer.validated_data["calls"]
+        denied = sorted({
+            call["command"] for call in calls
+            if call["command"] not in settings.DJANGO_COMMANDS_ALLOW_REMOTE_CALL
+        })
+        if denied:
+            raise PermissionDenied(f"you are not allowed to call command `{'`, `'.join(denied)}`")
+        return Response({"results": start_jobs(calls)})
+
+
+class CommandJobSerializer(ModelSerializer):
+
+    class Meta:
+        model = CommandJob
+        fields = [
+            "job_id", "command", "using", "args", "kwargs", "status", "output", "error",
+            "create_datetime", "start_datetime", "finish_datetime", "idempotency_key",
+        ]
+
+
+class CommandJobView(CommandAPIView):
+    """
+    the status and output of a job.
+    ?wait=<seconds> waits at most MAX_WAIT seconds until the job is finished or failed (long poll)
+    """
+    MAX_WAIT = 30
+    POLL_INTERVAL = 0.5
+
+    def get(self, request, job_id, *args, **kwargs):
+        try:
+            wait = float(request.query_params.get("wait", 0))
+        except ValueError as error:
+            raise ValidationError({"wait": ["a number of seconds is required"]}) from error
+        if not math.isfinite(wait):
+            raise ValidationError({"wait": ["a number of seconds is required"]})
+        job = get_object_or_404(CommandJob, job_id=job_id)
+        job = wait_job(job, min(wait, self.MAX_WAIT), self.POLL_INTERVAL)
+        return Response(CommandJobSerializer(job).data)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    accept text/event-stream, the errors are rendered as json
+    """
+    media_type = "text/event-stream"
+    format = "event-stream"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, str):
+            return data
+        return json.dumps(data)
+
+
+class CommandJobStreamView(CommandAPIView):
+    """
+    tail the output of a job as server-sent events:
+
+        id: <offset>
+        event: output
+        data: <new output>
+
+    the stream ends with an "end" event of the status, ?offset= or the Last-Event-ID header resumes it.
+    a stream is closed after MAX_DURATION seconds so it doesn't hold a worker, the EventSource reconnects
+    with the Last-Event-ID.
+    """
+    POLL_INTERVAL = 0.5
+    MAX_DURATION = 300
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+
+    def get(self, request, job_id, *args, **kwargs):
+        try:
+            offset = int(request.query_params.get("offset") or request.headers.get("Last-Event-ID") or 0)
+        except ValueError as error:
+            raise ValidationError({"offset": ["a non-negative integer is required"]}) from error
+        if offset < 0:
+            raise ValidationError({"offset": ["a non-negative integer is required"]})
+        job = get_object_or_404(CommandJob, job_id=job_id)
+        response = StreamingHttpResponse(self.stream(job.pk, offset), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def stream(self, pk: int, offset: int):
+        deadline = time.monotonic() + self.MAX_DURATION
+        while True:
+            job = CommandJob.objects.filter(pk=pk).annotate(
+                    new_output=Substr("output", offset + 1)).values("status", "new_output").get()
+            if job["new_output"]:
+                offset += len(job["new_output"])
+                yield self.format_event("output", job["new_output"], offset)
+            if job["status"] in CommandJob.DONE_STATUS:
+                yield self.format_event("end", json.dumps({"status": job["status"]}), offset)
+                return
+            if time.monotonic() >= deadline:
+                return
+            time.sleep(self.POLL_INTERVAL)
+
+    @staticmethod
+    def format_event(event: str, data: str, offset: int) -> str:
+        lines = "".join(f"data: {line}\n" for line in data.split("\n"))
+        return f"id: {offset}\nevent: {event}\n{lines}\n"